@@ -0,0 +1,332 @@
+"""ASGI server mode for high numbers of concurrent connections.
+
+Run it with any ASGI server, for example:
+
+    pip install uvicorn
+    uvicorn asgi:app --port 5000
+
+or simply `python asgi.py`. The long-lived routes (/render_info/wait and
+/render_info/stream) are served natively on the event loop: a waiting client
+is just a suspended task, so one process can hold thousands of them. Storage
+reads for those routes run on a small thread pool so they never block the
+loop. Every other route is passed to the Flask app in game.py on a separate
+thread pool, so both server modes expose exactly the same API.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import game
+from metrics import label_route
+
+# Threads for blocking storage calls made by the native async routes
+STORAGE_THREADS = int(os.environ.get('ASGI_STORAGE_THREADS', 16))
+# Threads running ordinary Flask requests
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+
+_storage_pool = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix='storage')
+_wsgi_pool = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+# Start logging and the background store warm-up
+game.create_app()
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    handler = _ROUTES.get(scope['path'])
+    if handler is not None and scope['method'] == 'GET':
+        if game.metrics is None:
+            await handler(scope, receive, send)
+        else:
+            await _measured(handler, scope, receive, send)
+    else:
+        await _call_flask(scope, receive, send)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _storage_pool.shutdown(wait=False)
+            _wsgi_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _measured(handler, scope, receive, send):
+    """Run a native route, counting it and timing it like a Flask request."""
+    started = time.perf_counter()
+    status = {}
+
+    async def send_with_status(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_with_status)
+    finally:
+        game.metrics.observe_request(scope['path'], scope['method'], status.get('code', 500),
+                                     time.perf_counter() - started)
+
+
+async def _get_room(room_key, route):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_storage_pool, _read_room, room_key, route)
+
+
+def _read_room(room_key, route):
+    # Runs on the storage pool, so the route label is set on that thread
+    with label_route(game.metrics, route):
+        return game.store.snapshot(room_key)
+
+
+async def wait_render_info(scope, receive, send):
+    """Async version of game.wait_render_info."""
+    args = _query_args(scope)
+    room_key = args.get('room_key')
+    player_token = args.get('player_token')
+    try:
+        since_version = int(args.get('since_version', -1))
+        timeout = min(float(args.get('timeout', game.LONG_POLL_TIMEOUT)), game.LONG_POLL_TIMEOUT)
+    except ValueError:
+        since_version, timeout = -1, game.LONG_POLL_TIMEOUT
+
+    if not all([room_key, player_token]):
+        await _send_json(send, {'error': 'Missing required parameters (room_key, player_token)'}, 400)
+        return
+    if await _redirect_to_owner(scope, send, room_key):
+        return
+    if game.token_index.rejects(room_key, player_token):
+        await _send_json(send, {'error': 'Invalid player token'}, 403)
+        return
+
+    deadline = time.monotonic() + timeout
+    try:
+        # Listen before reading so a write in between still wakes us up
+        async with game.room_events.listen_async(room_key) as listener:
+            while True:
+                room_data = await _get_room(room_key, '/render_info/wait')
+                if room_data is None:
+                    await _send_json(send, {'error': 'Room not found'}, 404)
+                    return
+
+                response, status_code = game.player_view(room_data, player_token, room_key)
+                if status_code != 200:
+                    await _send_json(send, response, status_code)
+                    return
+                if room_data.get('version', 0) > since_version:
+                    await _send_json(send, dict(response, changed=True), 200)
+                    return
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not await listener.wait(remaining):
+                    await _send_json(send, {'changed': False, 'version': since_version}, 200)
+                    return
+    except Exception as e:
+        await _send_json(send, {'error': str(e)}, 500)
+
+
+async def stream_render_info(scope, receive, send):
+    """Async version of game.stream_render_info."""
+    args = _query_args(scope)
+    room_key = args.get('room_key')
+    player_token = args.get('player_token')
+    headers = dict(scope['headers'])
+    try:
+        last_version = int(headers.get(b'last-event-id', b'').decode() or args.get('since_version', -1))
+    except ValueError:
+        last_version = -1
+
+    if not all([room_key, player_token]):
+        await _send_json(send, {'error': 'Missing required parameters (room_key, player_token)'}, 400)
+        return
+    if await _redirect_to_owner(scope, send, room_key):
+        return
+    if game.token_index.rejects(room_key, player_token):
+        await _send_json(send, {'error': 'Invalid player token'}, 403)
+        return
+
+    # Reject bad requests with a normal error before starting the stream
+    room_data = await _get_room(room_key, '/render_info/stream')
+    if room_data is None:
+        await _send_json(send, {'error': 'Room not found'}, 404)
+        return
+    response, status_code = game.player_view(room_data, player_token, room_key)
+    if status_code != 200:
+        await _send_json(send, response, status_code)
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': _headers({
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }),
+    })
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    deadline = time.monotonic() + game.STREAM_MAX_DURATION
+    try:
+        async with game.room_events.listen_async(room_key) as listener:
+            while time.monotonic() < deadline and not disconnected.done():
+                room_data = await _get_room(room_key, '/render_info/stream')
+                if room_data is None:
+                    await _send_chunk(send, 'event: error\ndata: {"error": "Room not found"}\n\n')
+                    break
+                version = room_data.get('version', 0)
+                if version != last_version:
+                    response, status_code = game.player_view(room_data, player_token, room_key)
+                    if status_code != 200:
+                        await _send_chunk(send, f'event: error\ndata: {json.dumps(response)}\n\n')
+                        break
+                    await _send_chunk(send, f'id: {version}\nevent: state\ndata: {json.dumps(response)}\n\n')
+                    last_version = version
+                if not await listener.wait(game.STREAM_HEARTBEAT):
+                    await _send_chunk(send, ': keep-alive\n\n')
+    finally:
+        disconnected.cancel()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _redirect_to_owner(scope, send, room_key):
+    """Redirect to the process that owns room_key, as game.route_to_owner does.
+
+    Returns:
+        bool: True if a redirect was sent
+    """
+    owner = game.shards.owner(room_key) if game.shards is not None else None
+    if owner is None:
+        return False
+    location = scope['path'] + ('?' + scope['query_string'].decode('latin-1') if scope['query_string'] else '')
+    await send({
+        'type': 'http.response.start',
+        'status': 307,
+        'headers': _headers({'Location': owner + location, 'Content-Length': '0'}),
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+    return True
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _call_flask(scope, receive, send):
+    """Run one request through the Flask app on the WSGI thread pool."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    environ = _wsgi_environ(scope, bytes(body))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    def run():
+        result = game.app(environ, start_response)
+        try:
+            return b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    loop = asyncio.get_running_loop()
+    content = await loop.run_in_executor(_wsgi_pool, run)
+    await send({
+        'type': 'http.response.start',
+        'status': started['status'],
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in started['headers']],
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _query_args(scope):
+    return {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+
+def _headers(headers):
+    headers = dict(headers, **game.CORS_HEADERS)
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+
+
+async def _send_json(send, payload, status_code):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': _headers({'Content-Type': 'application/json', 'Content-Length': str(len(body))}),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+
+# Routes served natively on the event loop; everything else goes to Flask
+_ROUTES = {
+    '/render_info/wait': wait_render_info,
+    '/render_info/stream': stream_render_info,
+}
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('The ASGI server mode needs an ASGI server: pip install uvicorn')
+    uvicorn.run('asgi:app', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,325 @@
+"""Build and serve the card images and music.
+
+    python assets.py                      # writes build/assets
+    python assets.py --scales 1,0.5,0.25
+
+The build turns the images used by the card catalog (plus the card back)
+into:
+
+- a texture atlas per resolution, as WebP and as optimized PNG, with a JSON
+  map of where each card sits in it,
+- recompressed copies of every image at every resolution, and
+- copies of the music,
+
+all with a content hash in the file name (tuna1@1x.3f2a9c1e5b.webp). A
+fingerprinted file never changes, so the server sends it with
+Cache-Control: immutable and a client downloads it once. asset-map.json is
+the entry point: it maps every original path (cards/tuna1.png) to its built
+files and lists the atlases.
+
+The server also answers /assets/manifest with the content hash and size of
+every card image, so clients can preload the whole set and refetch only what
+changed after a deploy.
+
+Pillow is needed for the atlas and recompression (pip install Pillow).
+Without it the build only fingerprints the original files.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+
+from flask import Response, request, send_from_directory
+
+from cards import card_images
+
+# Where the build writes and the server reads, relative to this file
+BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'assets')
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSET_MAP = 'asset-map.json'
+
+# Image drawn for face-down cards; not part of the catalog
+CARD_BACK = 'cards/card_back.png'
+MUSIC_DIR = 'music'
+DEFAULT_SCALES = (1.0, 0.5)
+WEBP_QUALITY = 85
+# Widest atlas at 1x, and the gap between packed images so scaled
+# sampling doesn't bleed into neighbours
+ATLAS_MAX_WIDTH = 2048
+ATLAS_PADDING = 2
+
+# Characters of the content hash kept in file names
+FINGERPRINT_LENGTH = 10
+_FINGERPRINTED = re.compile(r'\.[0-9a-f]{%d}\.\w+$' % FINGERPRINT_LENGTH)
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def fingerprint(data):
+    """Return the short content hash used in built file names."""
+    return hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def _write(out_dir, name, data):
+    """Write data as name.<hash>.<ext> under out_dir and return its relative path."""
+    stem, ext = os.path.splitext(name)
+    path = f'{stem}.{fingerprint(data)}{ext}'
+    full_path = os.path.join(out_dir, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as f:
+        f.write(data)
+    return path.replace(os.sep, '/')
+
+
+def _scale_label(scale):
+    return f'{scale:g}x'
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'webp':
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=6)
+    else:
+        image.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _scaled(image, scale):
+    from PIL import Image
+
+    if scale == 1:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def pack(sizes, max_width):
+    """Place rectangles in rows (tallest first), wrapping at max_width.
+
+    Args:
+        sizes: {name: (width, height)}
+        max_width: Widest the atlas may be
+
+    Returns:
+        tuple: ({name: (x, y)}, (atlas_width, atlas_height))
+    """
+    positions = {}
+    x = y = row_height = width = 0
+    for name, (w, h) in sorted(sizes.items(), key=lambda item: (-item[1][1], item[0])):
+        if x and x + w > max_width:
+            x, y = 0, y + row_height + ATLAS_PADDING
+            row_height = 0
+        positions[name] = (x, y)
+        x += w + ATLAS_PADDING
+        width = max(width, x - ATLAS_PADDING)
+        row_height = max(row_height, h)
+    return positions, (width, y + row_height)
+
+
+def build_assets(out_dir=BUILD_DIR, scales=DEFAULT_SCALES, source_dir=SOURCE_DIR):
+    """Build every asset into out_dir, replacing what was there.
+
+    Returns:
+        dict: The asset map that was written to out_dir/asset-map.json
+
+    Raises:
+        ValueError: If out_dir is neither empty nor an earlier build's
+            output (has no asset-map.json), so it is never wiped
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+        print('Pillow is not installed (pip install Pillow): images are only fingerprinted.', file=sys.stderr)
+
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        if not os.path.isfile(os.path.join(out_dir, ASSET_MAP)):
+            raise ValueError(f'Refusing to replace {out_dir}: it is not empty and has no {ASSET_MAP}')
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    image_paths = []
+    for path in card_images() + [CARD_BACK]:
+        if os.path.exists(os.path.join(source_dir, path)):
+            image_paths.append(path)
+        else:
+            print(f'Missing image, skipped: {path}', file=sys.stderr)
+
+    asset_map = {'images': {}, 'atlases': {}, 'music': {}}
+    if Image is None:
+        for path in image_paths:
+            with open(os.path.join(source_dir, path), 'rb') as f:
+                asset_map['images'][path] = {'1x': {'png': _write(out_dir, path, f.read())}}
+    else:
+        originals = {}
+        for path in image_paths:
+            with Image.open(os.path.join(source_dir, path)) as image:
+                originals[path] = image.convert('RGBA')
+        for scale in scales:
+            label = _scale_label(scale)
+            images = {path: _scaled(image, scale) for path, image in originals.items()}
+
+            # Each image on its own
+            for path, image in images.items():
+                stem = os.path.splitext(path)[0]
+                asset_map['images'].setdefault(path, {})[label] = {
+                    fmt: _write(out_dir, f'{stem}@{label}.{fmt}', _encode(image, fmt)) for fmt in ('webp', 'png')
+                }
+
+            # All of them in one atlas
+            positions, size = pack({path: image.size for path, image in images.items()},
+                                   max(1, round(ATLAS_MAX_WIDTH * scale)))
+            atlas = Image.new('RGBA', size, (0, 0, 0, 0))
+            for path, (x, y) in positions.items():
+                atlas.paste(images[path], (x, y))
+            frames = {path: [x, y, *images[path].size] for path, (x, y) in sorted(positions.items())}
+            asset_map['atlases'][label] = {
+                'width': size[0],
+                'height': size[1],
+                'webp': _write(out_dir, f'atlas@{label}.webp', _encode(atlas, 'webp')),
+                'png': _write(out_dir, f'atlas@{label}.png', _encode(atlas, 'png')),
+                'frames': _write(out_dir, f'atlas@{label}.json',
+                                 json.dumps(frames, indent=1, sort_keys=True).encode('utf-8')),
+            }
+
+    music_dir = os.path.join(source_dir, MUSIC_DIR)
+    for name in sorted(os.listdir(music_dir)) if os.path.isdir(music_dir) else []:
+        path = f'{MUSIC_DIR}/{name}'
+        with open(os.path.join(source_dir, path), 'rb') as f:
+            asset_map['music'][path] = _write(out_dir, path, f.read())
+
+    with open(os.path.join(out_dir, ASSET_MAP), 'w') as f:
+        json.dump(asset_map, f, indent=1, sort_keys=True)
+    return asset_map
+
+
+class AssetManifest:
+    """Content hash and byte size of every card image, built once.
+
+    Served on /assets/manifest so a client can preload every image up front
+    and, after a deploy, refetch only the ones whose hash changed. Images
+    that went through build_assets() also list their built files.
+    """
+
+    def __init__(self, source_dir=SOURCE_DIR, asset_dir=BUILD_DIR):
+        self.source_dir = source_dir
+        self.asset_dir = asset_dir
+        self._body = None
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Hash the images now instead of on the first request."""
+        self.get()
+
+    def get(self):
+        """Return (body, etag), building them on the first call."""
+        if self._body is None:
+            with self._lock:
+                if self._body is None:
+                    manifest = self.build()
+                    self._etag = manifest['version']
+                    self._body = json.dumps(manifest, sort_keys=True)
+        return self._body, self._etag
+
+    def build(self):
+        """Return the manifest as a dict."""
+        asset_map = {}
+        asset_map_path = os.path.join(self.asset_dir, ASSET_MAP)
+        if os.path.exists(asset_map_path):
+            with open(asset_map_path) as f:
+                asset_map = json.load(f)
+
+        images = {}
+        for path in card_images() + [CARD_BACK]:
+            full_path = os.path.join(self.source_dir, path)
+            if not os.path.exists(full_path):
+                continue
+            with open(full_path, 'rb') as f:
+                data = f.read()
+            entry = {'hash': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+            if path in asset_map.get('images', {}):
+                entry['built'] = asset_map['images'][path]
+            images[path] = entry
+
+        manifest = {'images': images, 'atlases': asset_map.get('atlases', {})}
+        # Changes whenever any image or built file does
+        manifest['version'] = fingerprint(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+        return manifest
+
+
+def init_app(app, asset_dir=None, source_dir=SOURCE_DIR):
+    """Serve the asset manifest and the built assets under /assets/.
+
+    Fingerprinted files are cached forever; anything else (asset-map.json)
+    must be revalidated. Range requests are supported, so music can be
+    streamed and seeked.
+
+    Args:
+        app: The Flask app
+        asset_dir: Directory written by build_assets(). Defaults to
+            $ASSET_DIR, then BUILD_DIR.
+        source_dir: Directory holding the original cards/ images
+
+    Returns:
+        AssetManifest: The manifest served on /assets/manifest; call its
+                       load() at startup
+    """
+    asset_dir = os.path.abspath(asset_dir or os.environ.get('ASSET_DIR', BUILD_DIR))
+    manifest = AssetManifest(source_dir, asset_dir)
+
+    @app.route('/assets/manifest', methods=['GET'])
+    def asset_manifest():
+        """List every card image with its content hash and size."""
+        body, etag = manifest.get()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # Always revalidate
+        return response
+
+    @app.route('/assets/<path:filename>', methods=['GET'])
+    def built_asset(filename):
+        """Serve one built asset file."""
+        response = send_from_directory(asset_dir, filename, conditional=True, etag=True)
+        if _FINGERPRINTED.search(filename):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the card atlas, images and music.')
+    parser.add_argument('--out', default=BUILD_DIR, help='output directory (replaced)')
+    parser.add_argument('--scales', default=','.join(f'{s:g}' for s in DEFAULT_SCALES),
+                        help='comma-separated resolutions, e.g. 1,0.5')
+    args = parser.parse_args(argv)
+
+    scales = [float(scale) for scale in args.scales.split(',') if scale.strip()]
+    try:
+        asset_map = build_assets(args.out, scales)
+    except ValueError as e:
+        parser.error(str(e))
+
+    total = 0
+    for root, _, files in os.walk(args.out):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    print(f"Built {len(asset_map['images'])} images, {len(asset_map['atlases'])} atlas(es) and "
+          f"{len(asset_map['music'])} music file(s) into {args.out} ({total / 1024:.0f} KiB)")
+    for label, atlas in asset_map['atlases'].items():
+        sizes = {fmt: os.path.getsize(os.path.join(args.out, atlas[fmt])) for fmt in ('webp', 'png')}
+        print(f"  atlas {label}: {atlas['width']}x{atlas['height']}, "
+              f"webp {sizes['webp'] / 1024:.0f} KiB, png {sizes['png'] / 1024:.0f} KiB")
+
+
+if __name__ == '__main__':
+    main()
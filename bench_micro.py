@@ -0,0 +1,217 @@
+"""Microbenchmarks for the functions that run on every request or new room.
+
+    python bench_micro.py --output baseline.json
+    # ...change something...
+    python bench_micro.py --compare baseline.json
+
+Timing works like pyperf: each benchmark is calibrated so one sample runs
+for at least MIN_SAMPLE_TIME, a few warm-up samples are thrown away, and
+the mean, standard deviation and median of the remaining samples are
+reported per call. Allocations are measured with tracemalloc on a separate
+call, as the peak bytes allocated during the call and the bytes still held
+afterwards.
+
+The rooms are built by playing real games with the engine, from a fresh
+room up to late game with long fields, so the numbers reflect realistic
+room sizes.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Must be set before game.py creates its store
+os.environ.setdefault('ROOM_STORE', 'memory')
+
+from cards import create_deck, shuffled_deck  # noqa: E402
+from engine import DRAW, PLAY, Action, new_game, step  # noqa: E402
+from game import verify_player_turn  # noqa: E402
+from views import filter_game_data_for_player  # noqa: E402
+
+# Shortest time one timing sample may take, in seconds
+MIN_SAMPLE_TIME = 0.01
+SAMPLES = 20
+WARMUPS = 3
+# Slowdown reported as a regression by --compare
+DEFAULT_THRESHOLD = 0.10
+
+# Room sizes to benchmark with: name -> turns played before measuring
+ROOM_STAGES = {'new': 0, 'mid': 20, 'late': 60}
+
+
+def make_room(turns, seed=0):
+    """Build room data as it looks after turns moves of a real game."""
+    rng = random.Random(seed)
+    state = new_game(rng)
+    for turn in range(turns):
+        hand = state.hands[state.current_turn - 1]
+        # Play while there are cards, drawing every third turn to keep hands going
+        action = Action(PLAY, 0) if hand and turn % 3 else Action(DRAW)
+        step(state, action, rng)
+
+    room_data = {
+        'players': [
+            {'hand': [], 'field': [], 'score': 0, 'token': 'a' * 64},
+            {'hand': [], 'field': [], 'score': 0, 'token': 'b' * 64},
+        ],
+        'pending_discard': [],
+        'version': turns + 2,
+    }
+    room_data.update(state.room_updates(room_data))
+    return room_data
+
+
+def time_call(func, min_time=MIN_SAMPLE_TIME, samples=SAMPLES, warmups=WARMUPS):
+    """Time func() the way pyperf does.
+
+    Returns:
+        dict: loops per sample and mean/stdev/median/min seconds per call
+    """
+    # Calibrate: double the loop count until one sample is long enough
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        if time.perf_counter() - started >= min_time:
+            break
+        loops *= 2
+
+    timings = []
+    for i in range(warmups + samples):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        if i >= warmups:
+            timings.append((time.perf_counter() - started) / loops)
+
+    return {
+        'loops': loops,
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'median': statistics.median(timings),
+        'min': min(timings),
+    }
+
+
+def measure_allocations(func):
+    """Return the peak and retained bytes tracemalloc sees for one call of func."""
+    func()  # Warm up caches so one-time allocations aren't counted
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'peak_bytes': peak - before, 'retained_bytes': current - before}
+
+
+def benchmarks():
+    """Return the benchmarks to run as a name -> zero-argument callable dict."""
+    cases = {
+        'create_deck': create_deck,
+        'shuffled_deck': shuffled_deck,
+    }
+    for stage, turns in ROOM_STAGES.items():
+        room_data = make_room(turns)
+        token = room_data['players'][room_data['current_turn'] - 1]['token']
+        cases[f'filter_game_data_for_player[{stage}]'] = (
+            lambda room_data=room_data: filter_game_data_for_player(room_data, 1)
+        )
+        cases[f'verify_player_turn[{stage}]'] = (
+            lambda room_data=room_data, token=token: verify_player_turn(room_data, token, 'player_action')
+        )
+    cases['verify_player_turn[bad_token]'] = (
+        lambda room_data=make_room(0): verify_player_turn(room_data, 'c' * 64)
+    )
+    return cases
+
+
+def run(selected=None, samples=SAMPLES):
+    """Run the benchmarks, optionally only those whose names contain one of selected."""
+    results = {}
+    for name, func in benchmarks().items():
+        if selected and not any(part in name for part in selected):
+            continue
+        results[name] = dict(time_call(func, samples=samples), **measure_allocations(func))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Compare two run() results.
+
+    Returns:
+        tuple: (lines, regressions) where lines describe every benchmark
+               present in both and regressions names those whose median time
+               grew by more than threshold
+    """
+    lines = []
+    regressions = []
+    for name, result in current['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else 1.0
+        verdict = ''
+        if ratio > 1 + threshold:
+            verdict = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            verdict = '  faster'
+        lines.append(
+            f"{name:<42}{old['median'] * 1e6:>10.2f}us -> {result['median'] * 1e6:>8.2f}us"
+            f"  x{ratio:.2f}  alloc {old['peak_bytes']} -> {result['peak_bytes']} B{verdict}"
+        )
+    return lines, regressions
+
+
+def print_report(results):
+    """Print run() results as a table."""
+    print(f"Python {results['python']} on {results['platform']}\n")
+    print(f"{'benchmark':<42}{'median':>12}{'stdev':>11}{'peak B':>10}{'kept B':>10}")
+    for name, r in results['benchmarks'].items():
+        print(f"{name:<42}{r['median'] * 1e6:>10.2f}us{r['stdev'] * 1e6:>9.2f}us"
+              f"{r['peak_bytes']:>10}{r['retained_bytes']:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the microbenchmarks.')
+    parser.add_argument('names', nargs='*', help='only run benchmarks whose names contain one of these')
+    parser.add_argument('--samples', type=int, default=SAMPLES, help='timing samples per benchmark')
+    parser.add_argument('--output', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against a saved JSON baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='median slowdown counted as a regression (default 0.10)')
+    args = parser.parse_args(argv)
+
+    results = run(args.names, args.samples)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nSaved baseline to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, results, args.threshold)
+        print(f'\nCompared with {args.compare}:')
+        for line in lines:
+            print(line)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Load test for the HTTP routes.
+
+Plays complete games through Flask's test client against the in-memory room
+store, so no server or Firestore project is needed:
+
+    python bench_routes.py --rooms 200 --concurrency 16 --polls 4
+    python bench_routes.py --rooms 50 --json > before.json
+
+Every room goes through /create_room and /join_room, then the players take
+turns with /player_action and /discard_cards while both of them poll
+/render_info --polls times per move. Each route gets p50/p99 latency and
+requests/s from the concurrent run, and the peak memory allocated while
+handling a request from a separate single-threaded pass under tracemalloc
+(tracing slows everything down, so it is kept out of the timings).
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Must be set before game.py creates its store
+os.environ.setdefault('ROOM_STORE', 'memory')
+
+import game  # noqa: E402
+
+ROUTES = ('/create_room', '/join_room', '/render_info', '/player_action', '/discard_cards')
+
+
+class RouteRecorder:
+    """Collects per-route latencies, and optionally allocations, from many threads."""
+
+    def __init__(self, trace_allocations=False):
+        self.trace_allocations = trace_allocations
+        self.latencies = defaultdict(list)
+        self.allocations = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, client, route, url, ok=(200,)):
+        """Make one GET request and record it under route.
+
+        Returns:
+            dict: The decoded JSON response, or None for an empty body
+        """
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - started
+        if self.trace_allocations:
+            allocated = tracemalloc.get_traced_memory()[1] - before
+        with self._lock:
+            self.latencies[route].append(elapsed)
+            if self.trace_allocations:
+                self.allocations[route].append(allocated)
+            if response.status_code not in ok:
+                self.errors[route] += 1
+        return response.get_json(silent=True)
+
+
+def play_room(recorder, moves, polls):
+    """Create a room, join it and play moves turns while polling render_info."""
+    client = game.app.test_client()
+    created = recorder.call(client, '/create_room', '/create_room')
+    room_key = created['room_key']
+    joined = recorder.call(client, '/join_room', f'/join_room/{room_key}')
+    tokens = [created['first_player_token'], joined['second_player_token']]
+    # Each player's first turn passes with 5 cards in hand, which forces a
+    # discard, so /discard_cards is exercised too
+    discarded = [False, False]
+
+    for move in range(moves):
+        for _ in range(polls):
+            for token in tokens:
+                recorder.call(client, '/render_info',
+                              f'/render_info?room_key={room_key}&player_token={token}')
+
+        player = move % 2
+        token = tokens[player]
+        action_url = f'/player_action?room_key={room_key}&player_token={token}'
+        if not discarded[player]:
+            result = recorder.call(client, '/player_action', f'{action_url}&action=play&card_index=-1')
+            if result and result.get('needs_discard'):
+                indices = ','.join(str(i) for i in range(result['cards_to_discard']))
+                recorder.call(client, '/discard_cards',
+                              f'/discard_cards?room_id={room_key}&player_token={token}&card_indices={indices}')
+            discarded[player] = True
+        elif move % 4 < 2:
+            recorder.call(client, '/player_action', f'{action_url}&action=play&card_index=0', ok=(200, 400))
+        else:
+            recorder.call(client, '/player_action', f'{action_url}&action=draw&card_index=-1')
+
+
+def run(rooms=100, concurrency=8, moves=20, polls=4, alloc_rooms=5):
+    """Run the load test.
+
+    Args:
+        rooms: Number of games to play in the timed run
+        concurrency: Number of games played at the same time
+        moves: Turns per game
+        polls: render_info polls per player between moves
+        alloc_rooms: Games played under tracemalloc to measure allocations
+
+    Returns:
+        dict: route -> {requests, errors, p50_ms, p99_ms, requests_per_second,
+              alloc_bytes}
+    """
+    recorder = RouteRecorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(play_room, recorder, moves, polls) for _ in range(rooms)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    alloc_recorder = RouteRecorder(trace_allocations=True)
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_rooms):
+            play_room(alloc_recorder, moves, polls)
+    finally:
+        tracemalloc.stop()
+
+    results = {}
+    for route in ROUTES:
+        latencies = sorted(recorder.latencies[route])
+        if not latencies:
+            continue
+        allocations = alloc_recorder.allocations[route]
+        results[route] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[route],
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'requests_per_second': len(latencies) / elapsed,
+            'alloc_bytes': statistics.mean(allocations) if allocations else 0,
+        }
+    results['total'] = {
+        'requests': sum(r['requests'] for r in results.values()),
+        'errors': sum(r['errors'] for r in results.values()),
+        'elapsed': elapsed,
+        'requests_per_second': sum(r['requests'] for r in results.values()) / elapsed,
+    }
+    return results
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def print_report(results):
+    """Print run() results as a table."""
+    print(f"{'route':<16}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}{'alloc KiB':>11}")
+    for route in ROUTES:
+        if route not in results:
+            continue
+        r = results[route]
+        print(f"{route:<16}{r['requests']:>10}{r['errors']:>8}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+              f"{r['requests_per_second']:>10.0f}{r['alloc_bytes'] / 1024:>11.1f}")
+    total = results['total']
+    print(f"\n{total['requests']} requests in {total['elapsed']:.2f}s "
+          f"({total['requests_per_second']:,.0f} req/s), {total['errors']} errors")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the HTTP routes in-process.')
+    parser.add_argument('--rooms', type=int, default=100, help='games to play')
+    parser.add_argument('--concurrency', type=int, default=8, help='games played at the same time')
+    parser.add_argument('--moves', type=int, default=20, help='turns per game')
+    parser.add_argument('--polls', type=int, default=4, help='render_info polls per player between moves')
+    parser.add_argument('--alloc-rooms', type=int, default=5, help='games played under tracemalloc')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.rooms, args.concurrency, args.moves, args.polls, args.alloc_rooms)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
-from collections import defaultdict
+import hashlib
+import json
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
 
 # Card configuration with base image names (without numbers)
 CARDS = {
@@ -81,48 +84,186 @@ DECK_COMPOSITION = {
     'swamp_crocodile': 1
 }
 
-def create_deck():  
-    """Create a deck with unique card instances, each with its own image variation."""
-    deck = []
-    
-    # Track which image variation to use for each card type
-    variation_counters = defaultdict(int)
+class CardDef(NamedTuple):
+    """Immutable definition of a card, shared by every instance of it in a deck."""
+    name: str
+    type: str
+    value: Optional[int]
+    image: str
+    effect: Optional[str]
+
+    def to_dict(self):
+        """Return the card as the dict sent to clients."""
+        if self.type == 'impact':
+            return {'image': self.image, 'name': self.name, 'type': self.type, 'effect': self.effect}
+        return {'value': self.value, 'type': self.type, 'image': self.image, 'name': self.name}
+
+def build_catalog(composition=None):
+    """Compile CARDS, IMPACT_CARDS and a deck composition into one card per deck slot.
+
+    Args:
+        composition: card_name: quantity mapping. Defaults to DECK_COMPOSITION.
+
+    Returns:
+        tuple: A CardDef for every card in the deck
+    """
+    if composition is None:
+        composition = DECK_COMPOSITION
+    catalog = []
     
-    # First, handle regular animal cards
-    for card_name, quantity in DECK_COMPOSITION.items():
+    # First, regular animal cards in composition order
+    for card_name, quantity in composition.items():
         if card_name in IMPACT_CARDS:
-            continue  # Skip impact cards for now
-            
+            continue  # Impact cards go last
         card_data = CARDS.get(card_name)
         if not card_data:
             continue
-            
-        # For each copy of the card, create a copy of the card data
-        for _ in range(quantity):
-            # Create a deep copy of the card data to avoid modifying the original
-            card_copy = card_data.copy()
-            
-            # If the card has an image field, use it directly
-            if 'image' in card_copy:
-                card_copy['image'] = f"cards/{card_copy['image']}.png"
-            
-            # Add the card to the deck with its name
-            card_copy['name'] = card_name
-            deck.append(card_copy)
+        card = CardDef(card_name, card_data['type'], card_data['value'], f"cards/{card_data['image']}.png", None)
+        catalog.extend([card] * quantity)
     
-    # Then handle impact cards (1 of each)
+    # Then impact cards (1 of each)
     for card_name, card_data in IMPACT_CARDS.items():
-        card_copy = card_data.copy()
-        card_copy['name'] = card_name
-        card_copy['type'] = 'impact'
-        card_copy['effect'] = card_name
-        if 'image' in card_copy:
-            card_copy['image'] = f'cards/{card_copy["image"]}.png'
-        deck.append(card_copy)
+        if not composition.get(card_name):
+            continue
+        catalog.append(CardDef(card_name, 'impact', None, f"cards/{card_data['image']}.png", card_name))
+    return tuple(catalog)
+
+# Card ids: rooms store decks, hands and fields as lists of these and only
+# expand them into card dicts when building a response. A card's id is its
+# position here, so this list is append-only: add new cards at the end and
+# never reorder or remove entries, or cards in stored rooms change.
+CARD_IDS = (
+    'fast_tuna', 'yellow_seahorse', 'sea_turtle', 'elusive_jellyfish', 'happy_dolphin',
+    'shy_stingray', 'swift_swordfish', 'shark',
+    'tiny_mouse', 'quick_squirrel', 'mountain_goat', 'sly_fox', 'graceful_stag',
+    'savannah_zebra', 'fierce_wolf', 'regal_lion',
+    'pond_frog', 'red_crab', 'river_otter', 'swamp_crocodile',
+    'competition', 'confusion', 'domesticate', 'earthquake', 'flood', 'prey', 'scare',
+    'trap', 'virus',
+)
+CARD_ID = {name: card_id for card_id, name in enumerate(CARD_IDS)}
+
+_unnumbered = [name for name in (*CARDS, *IMPACT_CARDS) if name not in CARD_ID]
+if _unnumbered:
+    raise ValueError(f'Cards missing from CARD_IDS (append them): {", ".join(_unnumbered)}')
+
+def _card_def(name):
+    if name in IMPACT_CARDS:
+        return CardDef(name, 'impact', None, f"cards/{IMPACT_CARDS[name]['image']}.png", name)
+    card_data = CARDS[name]
+    return CardDef(name, card_data['type'], card_data['value'], f"cards/{card_data['image']}.png", None)
+
+# The CardDef of each card id, compiled once at import
+CARD_TABLE = tuple(_card_def(name) for name in CARD_IDS)
+
+# Response dict for each card id. These are shared and must not be modified.
+CARD_DICTS = tuple(card.to_dict() for card in CARD_TABLE)
+
+# An unshuffled deck of DECK_COMPOSITION; a new room only has to copy and
+# shuffle it
+DECK_TEMPLATE = tuple(CARD_ID[card.name] for card in build_catalog())
+
+def create_deck():  
+    """Create a deck with unique card instances, each with its own image variation."""
+    return [dict(CARD_DICTS[card]) for card in DECK_TEMPLATE]
+
+def shuffled_deck(rng=random):
+    """Create a shuffled deck of card ids for a new room."""
+    deck = list(DECK_TEMPLATE)
+    rng.shuffle(deck)
     return deck
 
-def initialize_cards():
-    """Initialize or update the cards in Firestore."""
+def card_images():
+    """Return the image path of every card in CARDS and IMPACT_CARDS, sorted."""
+    return sorted({f"cards/{data['image']}.png" for data in (*CARDS.values(), *IMPACT_CARDS.values())})
+
+def card_info(card):
+    """Return the card dict for a card id. Card dicts are returned unchanged.
+
+    The returned dict is shared and must not be modified.
+    """
+    if isinstance(card, int):
+        return CARD_DICTS[card]
+    return card
+
+def expand_cards(cards):
+    """Expand a list of card ids into card dicts for a response."""
+    return [card_info(card) for card in cards]
+
+# Firestore accepts at most 500 operations per batched write
+BATCH_LIMIT = 500
+# Batches committed at the same time by initialize_cards
+BATCH_WORKERS = 8
+
+def card_documents():
+    """Return the Firestore 'cards' collection contents as {document id: fields}."""
+    return {
+        f"{card['name']}_{i}": {
+            'name': card['name'],
+            'image': card['image'],
+            **{k: v for k, v in card.items() if k not in ['name', 'image']}
+        }
+        for i, card in enumerate(create_deck(), 1)
+    }
+
+def content_hash(document):
+    """Hash a card document's fields, independent of key order."""
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode('utf-8')).hexdigest()
+
+def plan_card_changes(existing, desired):
+    """Work out which card documents to write and delete.
+
+    Args:
+        existing: {document id: fields} currently in the collection
+        desired: {document id: fields} that should be there
+
+    Returns:
+        tuple: (writes, deletes, unchanged) where writes maps document ids to
+               new fields, deletes lists ids to remove and unchanged counts
+               documents whose content hash already matches
+    """
+    existing_hashes = {doc_id: content_hash(fields) for doc_id, fields in existing.items()}
+    writes = {
+        doc_id: fields for doc_id, fields in desired.items()
+        if existing_hashes.get(doc_id) != content_hash(fields)
+    }
+    deletes = sorted(doc_id for doc_id in existing if doc_id not in desired)
+    return writes, deletes, len(desired) - len(writes)
+
+def _commit_in_batches(db, operations, workers=BATCH_WORKERS):
+    """Commit (op, doc_ref, fields) operations in batches of up to BATCH_LIMIT, in parallel."""
+    chunks = [operations[i:i + BATCH_LIMIT] for i in range(0, len(operations), BATCH_LIMIT)]
+
+    def commit(chunk):
+        batch = db.batch()
+        for op, doc_ref, fields in chunk:
+            if op == 'delete':
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, fields)
+        batch.commit()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as pool:
+        # list() re-raises the first failed commit
+        list(pool.map(commit, chunks))
+    return len(chunks)
+
+def initialize_cards(dry_run=False):
+    """Initialize or update the cards in Firestore.
+
+    Only cards whose content changed are written, and cards no longer in the
+    deck are deleted, in batches of up to BATCH_LIMIT operations.
+
+    Args:
+        dry_run: Print the changes without writing anything
+
+    Returns:
+        bool: True on success
+    """
+    # Imported here so the game rules can be used without the Firebase SDK
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
     try:
         # Initialize Firebase Admin SDK
         cred = credentials.Certificate('vegan-cardgame-firebase-adminsdk-fbsvc-b2013bb175.json')
@@ -132,25 +273,31 @@ def initialize_cards():
         # Reference to the cards collection
         cards_ref = db.collection('cards')
         
-        # Clear existing cards
-        docs = cards_ref.stream()
-        for doc in docs:
-            doc.reference.delete()
+        # Read the current collection once and compare content hashes
+        existing = {doc.id: doc.to_dict() for doc in cards_ref.stream()}
+        desired = card_documents()
+        writes, deletes, unchanged = plan_card_changes(existing, desired)
         
-        # Create a deck with unique card instances
-        deck = create_deck()
+        if dry_run:
+            for doc_id, fields in writes.items():
+                if doc_id in existing:
+                    changed = sorted(k for k in set(fields) | set(existing[doc_id])
+                                     if fields.get(k) != existing[doc_id].get(k))
+                    print(f"~ {doc_id}: {', '.join(changed)}")
+                else:
+                    print(f"+ {doc_id} ({fields['image']})")
+            for doc_id in deletes:
+                print(f"- {doc_id}")
+            print(f"\nDry run: {len(writes)} to write, {len(deletes)} to delete, {unchanged} unchanged.")
+            return True
         
-        # Add each card to the collection
-        for i, card in enumerate(deck, 1):
-            doc_ref = cards_ref.document(f"{card['name']}_{i}")
-            doc_ref.set({
-                'name': card['name'],
-                'image': card['image'],
-                **{k: v for k, v in card.items() if k not in ['name', 'image']}
-            })
-            print(f"Added card: {card['name']} ({card['image']})")
+        # Deletes and writes touch different documents, so they can share batches
+        operations = [('delete', cards_ref.document(doc_id), None) for doc_id in deletes]
+        operations += [('set', cards_ref.document(doc_id), fields) for doc_id, fields in writes.items()]
+        batches = _commit_in_batches(db, operations) if operations else 0
         
-        print(f"\nSuccessfully added {len(deck)} cards to the Firestore 'cards' collection.")
+        print(f"Wrote {len(writes)} and deleted {len(deletes)} cards in {batches} batch(es); "
+              f"{unchanged} unchanged in the Firestore 'cards' collection.")
         return True
         
     except Exception as e:
@@ -164,8 +311,9 @@ def initialize_cards():
             pass
 
 if __name__ == '__main__':
+    dry_run = '--dry-run' in sys.argv[1:]
     print("Initializing cards in Firestore...\n")
-    if initialize_cards():
+    if initialize_cards(dry_run=dry_run):
         print("\nCard initialization completed successfully!")
     else:
         print("\nCard initialization failed. Please check the error messages above.")
\ No newline at end of file
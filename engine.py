@@ -0,0 +1,220 @@
+"""Headless game rules.
+
+The rules the player_action and discard_cards routes apply, with no Flask or
+storage involved, so games can be simulated as fast as Python allows:
+
+    state = new_game(random.Random(42))
+    outcome = step(state, Action(PLAY, 0))
+
+A GameState holds only card ids and a few counters. step() changes it in
+place and returns an Outcome describing what happened, or raises IllegalMove
+if the action isn't allowed. The routes load a state from the room, step it
+and write back the fields that changed.
+"""
+import random
+from typing import NamedTuple, Optional, Tuple
+
+from cards import DECK_TEMPLATE
+
+# Action kinds
+PLAY = 'play'        # Move a card from hand to field
+PASS = 'pass'        # End the turn without playing (may require a discard)
+DRAW = 'draw'        # Draw 2 cards, keeping at most 4 in hand
+DISCARD = 'discard'  # Discard 1 or 2 cards down to 4 and draw 2
+
+# Game phases, stored in the room as game_state
+PLAYER_ACTION = 'player_action'
+PLAYER_DISCARD = 'player_discard'
+
+HAND_LIMIT = 4
+CARDS_PER_DRAW = 2
+INITIAL_HAND = 5
+WINNING_SCORE = 7
+
+
+class IllegalMove(Exception):
+    """Raised by step() for an action the rules don't allow."""
+
+
+class Action(NamedTuple):
+    kind: str
+    card_index: int = -1
+    card_indices: Tuple[int, ...] = ()
+
+
+class Outcome(NamedTuple):
+    """What a step did. Card values are card ids."""
+    played: Optional[int] = None
+    drawn: Tuple[int, ...] = ()
+    discarded: Tuple[int, ...] = ()
+    needs_discard: int = 0
+    turn_ended: bool = True
+
+
+class GameState:
+    """Compact state of one game.
+
+    hands, fields and scores are indexed by player (0 or 1), while
+    current_turn is the player number (1 or 2) like in the room data. The
+    top of the deck is the end of the list.
+    """
+    __slots__ = ('deck', 'hands', 'fields', 'scores', 'discard_pile', 'current_turn', 'phase')
+
+    def __init__(self, deck, hands=None, fields=None, scores=None, discard_pile=None,
+                 current_turn=1, phase=PLAYER_ACTION):
+        self.deck = deck
+        self.hands = hands if hands is not None else [[], []]
+        self.fields = fields if fields is not None else [[], []]
+        self.scores = scores if scores is not None else [0, 0]
+        self.discard_pile = discard_pile if discard_pile is not None else []
+        self.current_turn = current_turn
+        self.phase = phase
+
+    def copy(self):
+        return GameState(
+            list(self.deck), [list(h) for h in self.hands], [list(f) for f in self.fields],
+            list(self.scores), list(self.discard_pile), self.current_turn, self.phase
+        )
+
+    @classmethod
+    def from_room(cls, room_data):
+        """Load the game state from room data. The room data is not modified."""
+        players = room_data.get('players', [])
+        return cls(
+            list(room_data.get('deck', [])),
+            [list(p.get('hand', [])) for p in players],
+            [list(p.get('field', [])) for p in players],
+            [p.get('score', 0) for p in players],
+            list(room_data.get('discard_pile', [])),
+            room_data.get('current_turn'),
+            room_data.get('game_state', PLAYER_ACTION)
+        )
+
+    def room_updates(self, room_data):
+        """Return the room fields that hold this state, keeping other player fields."""
+        return {
+            'players': [
+                dict(player, hand=self.hands[i], field=self.fields[i], score=self.scores[i])
+                for i, player in enumerate(room_data.get('players', []))
+            ],
+            'deck': self.deck,
+            'discard_pile': self.discard_pile,
+            'current_turn': self.current_turn,
+            'game_state': self.phase
+        }
+
+
+def new_game(rng=random):
+    """Start a game with a shuffled deck and both opening hands dealt."""
+    deck = list(DECK_TEMPLATE)
+    rng.shuffle(deck)
+    state = GameState(deck)
+    deal(state)
+    return state
+
+
+def deal(state, cards_each=INITIAL_HAND):
+    """Deal opening hands, alternating between the players."""
+    for _ in range(cards_each):
+        for hand in state.hands:
+            if state.deck:
+                hand.append(state.deck.pop())
+
+
+def draw(state, count=CARDS_PER_DRAW, rng=random):
+    """Take up to count cards off the deck, reshuffling the discard pile if it runs out."""
+    drawn = []
+    for _ in range(count):
+        if not state.deck and state.discard_pile:
+            state.deck = state.discard_pile
+            state.discard_pile = []
+            rng.shuffle(state.deck)
+        if state.deck:
+            drawn.append(state.deck.pop())
+    return drawn
+
+
+def legal_actions(state):
+    """List the actions the current player may take."""
+    hand = state.hands[state.current_turn - 1]
+    if state.phase == PLAYER_DISCARD:
+        if len(hand) == HAND_LIMIT + 1:
+            return [Action(DISCARD, card_indices=(i,)) for i in range(len(hand))]
+        return [
+            Action(DISCARD, card_indices=(i, j))
+            for i in range(len(hand)) for j in range(i + 1, len(hand))
+        ]
+    return [Action(PLAY, i) for i in range(len(hand))] + [Action(PASS), Action(DRAW)]
+
+
+def step(state, action, rng=random):
+    """Apply one action by the current player to state, in place.
+
+    Args:
+        state: The GameState to change
+        action: The Action to take
+        rng: Random source used if the discard pile has to be reshuffled
+
+    Returns:
+        Outcome: What happened
+
+    Raises:
+        IllegalMove: If the action isn't allowed. state is left unchanged.
+    """
+    player = state.current_turn - 1
+    hand = state.hands[player]
+    kind = action.kind
+
+    if kind == PLAY:
+        if action.card_index < 0 or action.card_index >= len(hand):
+            raise IllegalMove('Invalid card selection')
+        card = hand.pop(action.card_index)
+        state.fields[player].append(card)
+        _end_turn(state)
+        return Outcome(played=card)
+
+    if kind == PASS:
+        # With 5 or 6 cards the player has to discard down to 4 first
+        if len(hand) in (HAND_LIMIT + 1, HAND_LIMIT + 2):
+            state.phase = PLAYER_DISCARD
+            return Outcome(needs_discard=len(hand) - HAND_LIMIT, turn_ended=False)
+        _end_turn(state)
+        return Outcome()
+
+    if kind == DRAW:
+        drawn = draw(state, rng=rng)
+        hand.extend(drawn)
+        excess = ()
+        if len(hand) > HAND_LIMIT:
+            # Newest cards go back to the bottom of the deck
+            excess = tuple(hand[HAND_LIMIT:])
+            del hand[HAND_LIMIT:]
+            state.deck[:0] = excess
+        _end_turn(state)
+        return Outcome(drawn=tuple(drawn), discarded=excess)
+
+    if kind == DISCARD:
+        if state.phase != PLAYER_DISCARD:
+            raise IllegalMove(f'Invalid game state. Expected: {PLAYER_DISCARD}')
+        required = len(hand) - HAND_LIMIT if len(hand) in (HAND_LIMIT + 1, HAND_LIMIT + 2) else 0
+        if required == 0:
+            raise IllegalMove('No discards needed')
+        indices = action.card_indices
+        if len(indices) != required:
+            raise IllegalMove(f'You must discard exactly {required} card(s)')
+        if not all(isinstance(i, int) and 0 <= i < len(hand) for i in indices):
+            raise IllegalMove('One or more invalid card indices')
+        # Discarded cards go to the bottom of the deck, then draw 2
+        discarded = [hand.pop(i) for i in sorted(indices, reverse=True)]
+        state.deck[:0] = discarded
+        drawn = draw(state, rng=rng)
+        hand.extend(drawn)
+        _end_turn(state)
+        return Outcome(drawn=tuple(drawn), discarded=tuple(discarded))
+
+    raise IllegalMove(f'Invalid action: {kind}')
+
+
+def _end_turn(state):
+    state.current_turn = 2 if state.current_turn == 1 else 1
+    state.phase = PLAYER_ACTION
@@ -1,30 +1,127 @@
 import os
+import json
+import logging
+import hmac
 import secrets
-from flask import Flask, request, jsonify, make_response
-import firebase_admin
-from firebase_admin import credentials, firestore
-import random
+import threading
+from flask import Flask, Response, request, jsonify, make_response, redirect
 import string
 import time
-import copy
 from functools import wraps
-from cards import CARDS, DECK_COMPOSITION, create_deck
+from cards import CARDS, DECK_COMPOSITION, card_info, expand_cards, shuffled_deck
+from storage import FirestoreRoomStore, apply_move, create_room_store
+from room_cache import wrap_with_cache
+from room_events import NotifyingRoomStore, RoomEvents
+from room_keys import RoomKeyAllocator
+from room_shards import DEFAULT_SHARDS, create_scheduler
+from token_index import TokenIndex, TokenIndexingRoomStore
+from assets import init_app as init_assets
+from logs import configure_logging, get_logger, log_event
+from metrics import create_metrics, init_app as init_metrics, label_route, wrap_with_metrics
+from views import PlayerViewBuilder, build_player_view, filter_game_data_for_player
+from engine import (DISCARD, DRAW, PASS, PLAY, Action, GameState, IllegalMove,
+                    WINNING_SCORE, deal, step)
 
+# Longest a /render_info/wait request is held open, in seconds
+LONG_POLL_TIMEOUT = 25
+# How often an idle /render_info/stream sends a keep-alive, and how long a
+# stream lasts before the client has to reconnect
+STREAM_HEARTBEAT = 15
+STREAM_MAX_DURATION = 300
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate('vegan-cardgame-firebase-adminsdk-fbsvc-b2013bb175.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+
+log = get_logger()
+
+# Initialize room storage (Firestore unless ROOM_STORE says otherwise),
+# with an in-process cache in front so polling doesn't hit the store, and
+# change notifications for long-poll and streaming clients. The Firestore
+# client itself is only created on first use or by create_app()'s warm-up.
+room_events = RoomEvents()
+room_backend = create_room_store()
+# Tokens of every room seen are indexed by hash, so requests with a wrong
+# token can be rejected without reading the room
+token_index = TokenIndex(int(os.environ.get('TOKEN_INDEX_SIZE', 10000)))
+store = NotifyingRoomStore(
+    TokenIndexingRoomStore(wrap_with_cache(room_backend), token_index), room_events
+)
+
+# Prometheus metrics on /metrics when METRICS=1; with it off nothing is
+# wrapped or recorded
+metrics = create_metrics()
+store = wrap_with_metrics(store, metrics)
+
+# Moves on a room run one at a time on the room's shard thread, which keeps
+# recently changed rooms in memory. Off by default for Firestore, whose slow
+# writes would queue up behind each other (ROOM_SHARDS sets the number of
+# shards). With ROOM_SHARD_NODES set, each room also belongs to one server
+# process.
+shards = create_scheduler(
+    store, default_shards=0 if isinstance(room_backend, FirestoreRoomStore) else DEFAULT_SHARDS
+)
 
 # Initialize Flask app
 app = Flask(__name__)
+init_metrics(app, metrics)
+# Fingerprinted images and music built by assets.py, cached forever, and
+# the manifest clients use to preload every card image
+asset_manifest = init_assets(app)
+
+# Latest render_info view of each room for each player, serialized the
+# same way jsonify does
+view_builder = PlayerViewBuilder(serialize=lambda view: app.json.dumps(view) + '\n')
+
+# Headers that enable CORS for all routes
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,Authorization',
+    'Access-Control-Allow-Methods': 'GET,PUT,POST,DELETE,OPTIONS'
+}
+
+_started = False
+_start_lock = threading.Lock()
+
+def create_app():
+    """Finish starting the server and return the Flask app.
+    
+    Importing this module only defines the app. This starts the logging
+    thread and connects to the room store in the background, so a new
+    worker can take requests at once instead of waiting for Firestore.
+    Safe to call more than once.
+    
+    Use it as the WSGI entry point, e.g. gunicorn 'game:create_app()'.
+    
+    Returns:
+        Flask: The app
+    """
+    global _started
+    with _start_lock:
+        if not _started:
+            # Structured logs go through a queue to a background thread;
+            # LOG_LEVEL=DEBUG shows every request's parameters
+            configure_logging()
+            room_keys.prefill()
+            if shards is not None:
+                shards.start()
+            asset_manifest.load()
+            if hasattr(room_backend, 'warm_up'):
+                threading.Thread(target=_warm_up_store, name='store-warm-up', daemon=True).start()
+            _started = True
+    return app
+
+def _warm_up_store():
+    try:
+        room_backend.warm_up()
+    except Exception as e:
+        # The first request will connect (and report the problem) instead
+        log_event(log, logging.WARNING, 'store.warm_up_failed', error=str(e))
 
 # Enable CORS for all routes
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    for name, value in CORS_HEADERS.items():
+        response.headers.add(name, value)
+    if metrics is not None:
+        metrics.finish_request(response)
     return response
 
 def verify_player_turn(room_data, player_token, expected_state=None):
@@ -47,7 +144,7 @@ def verify_player_turn(room_data, player_token, expected_state=None):
     players = room_data.get('players', [])
     player = None
     for i, p in enumerate(players, 1):
-        if p.get('token') == player_token:
+        if tokens_match(p.get('token'), player_token):
             player = i
             break
     
@@ -65,68 +162,78 @@ def verify_player_turn(room_data, player_token, expected_state=None):
         
     return player, None, None
 
-def filter_game_data_for_player(game_data, player_number):
-    """
-    Filter game data to only show information visible to the requesting player.
+def run_move(room_key, move):
+    """Apply a move to a room, on the room's shard when sharding is on.
     
     Args:
-        game_data (dict): The complete game data from Firestore
-        player_number (int): The player number (1 or 2) making the request
+        room_key: Key of the room to change
+        move: Function taking the room data and returning (updates, result)
         
     Returns:
-        dict: Filtered game data with hidden information removed
+        tuple: (room_data, result), or (None, None) if the room does not exist
     """
-    if not game_data:
-        return {}
-        
-    # Create a deep copy to avoid modifying the original
-    filtered_data = copy.deepcopy(game_data)
-    
-    # Determine opponent number
-    opponent_number = 2 if player_number == 1 else 1
-    
-    # Hide opponent's hand but keep the image field
-    if 'players' in filtered_data and len(filtered_data['players']) >= opponent_number:
-        opponent_index = opponent_number - 1
-        if 'hand' in filtered_data['players'][opponent_index]:
-            # Show only the count of cards in opponent's hand, but keep the image field
-            filtered_data['players'][opponent_index]['hand'] = [
-                {'face_down': True, 'image': card.get('image', '')} 
-                for card in filtered_data['players'][opponent_index]['hand']
-            ]
-    
-    # Ensure image field is present in play area cards
-    if 'play_area' in filtered_data:
-        for card in filtered_data['play_area']:
-            if 'owner' in card and card['owner'] == opponent_number and card.get('face_down', False):
-                card['hidden'] = True
-            # Ensure image field exists
-            if 'image' not in card:
-                card['image'] = ''
+    if shards is None:
+        return apply_move(store, room_key, move)
+    return shards.apply_move(room_key, move)
+
+def owner_redirect(room_key):
+    """Return a redirect to the process that owns room_key, or None if it is this one."""
+    owner = shards.owner(room_key) if shards is not None else None
+    if owner is None:
+        return None
+    # 307 keeps the method and query string
+    return redirect(owner + request.full_path, code=307)
+
+@app.before_request
+def route_to_owner():
+    """Send every request for a room to the server process that owns it.
     
-    return filtered_data
+    Each process caches rooms and wakes its own long-poll and stream
+    clients, and only sees the writes made through it. So with
+    ROOM_SHARD_NODES set, reads of a room have to go to its owner as well
+    as moves, or a client on another process would see a frozen game.
+    """
+    if shards is None or shards.ring is None:
+        return None
+    view_args = request.view_args or {}
+    room_key = (view_args.get('room_key') or view_args.get('room_id')
+                or request.args.get('room_key') or request.args.get('room_id'))
+    if not room_key:
+        return None
+    return owner_redirect(room_key)
 
 def generate_room_key(length=8):
     """Generate a unique room key."""
     alphabet = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
+def generate_owned_room_key():
+    """Generate a room key this process owns, so new rooms stay where they were created."""
+    while True:
+        room_key = generate_room_key()
+        if shards is None or shards.owner(room_key) is None:
+            return room_key
+
 def generate_token(length=32):
     """Generate a secure token."""
     return secrets.token_hex(length)
 
+# New rooms are only created if their key is free. Keys come from a pool
+# generated in advance and are checked against the keys known to be taken
+# before the store is asked.
+room_keys = RoomKeyAllocator(store, generate_owned_room_key, int(os.environ.get('ROOM_KEY_POOL', 256)))
+
 @app.route('/create', methods=['GET'])
 @app.route('/create_room', methods=['GET'])
 def create_room():
     """Create a new room with a unique key and token."""
     try:
-        # Generate unique room credentials
-        room_key = generate_room_key()
+        # Generate the first player's credentials; the room key is picked
+        # when the room is stored
         first_player_token = generate_token()
         
-        # Initialize deck with cards from cards.py and shuffle
-        deck = create_deck()
-        random.shuffle(deck)
+        # Shuffle a copy of the prebuilt deck template from cards.py
+        deck = shuffled_deck()
         
         # Create room data with initial game state
         room_data = {
@@ -151,8 +258,8 @@ def create_room():
             'pending_discard': []  # Store selected cards for discarding
         }
         
-        # Store room in Firestore
-        db.collection('rooms').document(room_key).set(room_data)
+        # Store the room under a key no other room has
+        room_key = room_keys.allocate(room_data)
         
         return jsonify({
             'room_key': room_key,
@@ -163,127 +270,111 @@ def create_room():
             'error': str(e)
         }), 500
 
-def deal_initial_cards(room_ref):
-    """Deal initial cards to both players."""
-    # Get fresh room data
-    room_snapshot = room_ref.get()
-    room_data = room_snapshot.to_dict()
+def join_turn(room_data, second_player_token):
+    """Work out the outcome of a join_room request on one room state.
     
-    deck = room_data.get('deck', []).copy()
-    players = room_data.get('players', [{'hand': []}, {'hand': []}]).copy()
+    The second seat is only claimed if it is still free, and both opening
+    hands are dealt in the same write, so two players racing to join can't
+    both get in or be dealt twice.
     
+    Args:
+        room_data: The room data dictionary (not modified)
+        second_player_token: Token for the joining player
+        
+    Returns:
+        tuple: (updates, (response, status_code)) where updates holds the
+               fields to write, or None if nothing changes
+    """
+    players = [dict(player) for player in room_data.get('players', [])]
+    if not players:
+        return None, ({'error': 'Room has no players'}, 500)
+    if len(players) >= 2 and players[1].get('token') is not None:
+        return None, ({'error': 'Room is already full'}, 400)
+        
+    # Take the second seat
+    if len(players) < 2:
+        players.append({'hand': [], 'field': [], 'score': 0, 'token': second_player_token})
+    else:
+        players[1].update({
+            'hand': players[1].get('hand', []),
+            'field': players[1].get('field', []),
+            'score': players[1].get('score', 0),
+            'token': second_player_token
+        })
+        
     # Deal 5 cards to each player
-    for _ in range(5):
-        for i in range(2):
-            if deck and i < len(players):
-                if 'hand' not in players[i]:
-                    players[i]['hand'] = []
-                card = deck.pop()
-                if isinstance(card, dict) and 'image' not in card:
-                    card['image'] = ''
-                players[i]['hand'].append(card)
-    
-    # Update only the necessary fields using set with merge
-    update_data = {
-        'players': players,
-        'deck': deck
-    }
-    room_ref.set(update_data, merge=True)  # Use set with merge to preserve other fields
+    joined = dict(room_data, players=players)
+    state = GameState.from_room(joined)
+    deal(state)
+    return state.room_updates(joined), ({'second_player_token': second_player_token}, 200)
 
 @app.route('/join/<room_key>')
 @app.route('/join_room/<room_key>', methods=['GET'])
 def join_room(room_key):
     """Join an existing room."""
     try:
-        # Get room from Firestore
-        room_ref = db.collection('rooms').document(room_key)
-        room = room_ref.get()
-        
-        if not room.exists:
-            return jsonify({
-                'error': 'Room does not exist'
-            }), 404
-            
-        # Get room data
-        room_data = room.to_dict()
-        
-        # Check if second player already exists
-        if len(room_data.get('players', [])) >= 2 and room_data['players'][1]['token'] is not None:
-            return jsonify({
-                'error': 'Room is already full'
-            }), 400
-            
         # Generate second player token
         second_player_token = generate_token()
-        print(f"Generated second player token: {second_player_token}")
+        log_event(log, logging.DEBUG, 'join_room.token_generated', room_key=room_key,
+                  second_player_token=second_player_token)
         
-        try:
-            # First, get the current room data
-            room_snapshot = room_ref.get()
-            room_data = room_snapshot.to_dict()
-            players = room_data.get('players', []).copy()  # Create a copy to modify
-            
-            print(f"Current players before update: {players}")
-            
-            # Ensure we have at least one player (should always be true)
-            if not players:
-                raise ValueError("Room has no players")
-            
-            # Create or update the second player
-            if len(players) < 2:
-                # Add new second player
-                players.append({
-                    'hand': [],
-                    'field': [],
-                    'score': 0,
-                    'token': second_player_token
-                })
-                print("Added new second player")
-            else:
-                # Update existing second player
-                if 'token' in players[1] and players[1]['token']:
-                    print(f"Replacing existing token: {players[1]['token']}")
-                players[1].update({
-                    'hand': players[1].get('hand', []),
-                    'field': players[1].get('field', []),
-                    'score': players[1].get('score', 0),
-                    'token': second_player_token
-                })
-                print("Updated existing second player")
-            
-            # Update the document directly (not in a transaction for now)
-            update_data = {'players': players}
-            print(f"Updating with data: {update_data}")
-            
-            # Use set with merge=True to preserve other fields
-            room_ref.set(update_data, merge=True)
-            
-            # Verify the update
-            updated_room = room_ref.get()
-            updated_players = updated_room.to_dict().get('players', [])
-            print(f"Players after update: {updated_players}")
-            
-            if len(updated_players) > 1 and updated_players[1].get('token') != second_player_token:
-                print("WARNING: Token mismatch after update!")
-                # Try one more time with a fresh update
-                updated_players[1]['token'] = second_player_token
-                room_ref.update({'players': updated_players})
-                
-        except Exception as e:
-            print(f"Error in join_room: {str(e)}")
-            raise
+        # Claim the seat and deal as a single conditional write on the
+        # room's shard
+        room_data, result = run_move(
+            room_key,
+            lambda room_data: join_turn(room_data, second_player_token)
+        )
         
-        # Deal initial cards to both players
-        deal_initial_cards(room_ref)
+        if room_data is None:
+            return jsonify({
+                'error': 'Room does not exist'
+            }), 404
+        room_keys.mark_taken(room_key)
         
-        return jsonify({
-            'second_player_token': second_player_token
-        })
+        response, status_code = result
+        if status_code == 200:
+            log_event(log, logging.DEBUG, 'join_room.joined', room_key=room_key)
+        return jsonify(response), status_code
     except Exception as e:
+        log_event(log, logging.ERROR, 'join_room.error', room_key=room_key, error=str(e))
         return jsonify({
             'error': str(e)
         }), 500
 
+def tokens_match(stored_token, player_token):
+    """Compare tokens in constant time. A missing token never matches."""
+    if not isinstance(stored_token, str) or not isinstance(player_token, str):
+        return False
+    return hmac.compare_digest(stored_token.encode('utf-8'), player_token.encode('utf-8'))
+
+def find_player(room_data, player_token):
+    """Return the index of the player holding player_token, or None."""
+    for i, player in enumerate(room_data.get('players', [])):
+        if tokens_match(player.get('token'), player_token):
+            return i
+    return None
+
+def player_view(room_data, player_token, room_key=None):
+    """Build the render_info view of a room for the player holding player_token.
+    
+    Args:
+        room_data: The room data dictionary
+        player_token: The player's authentication token
+        room_key: Key of the room. If given, unchanged parts of the view are
+            reused between versions of the room.
+        
+    Returns:
+        tuple: (response, status_code). The response may be shared with other
+               requests and must not be modified.
+    """
+    player_idx = find_player(room_data, player_token)
+    if player_idx is None:
+        return {'error': 'Invalid player token'}, 403
+    
+    if room_key is None:
+        return build_player_view(room_data, player_idx)[0], 200
+    return view_builder.view(room_key, room_data, player_idx), 200
+
 @app.route('/render_info', methods=['GET'])
 def render_info():
     """Get the current game state for rendering."""
@@ -292,54 +383,226 @@ def render_info():
         room_key = request.args.get('room_key')
         player_token = request.args.get('player_token')
                 
-        print(f"Received request with params - room_key: {room_key}, player_token: {player_token}")
+        log_event(log, logging.DEBUG, 'render_info.request', sample='render_info',
+                  room_key=room_key, player_token=player_token)
         
         # Check for required parameters
         if not all([room_key, player_token]):
             return jsonify({'error': 'Missing required parameters (room_key, player_token)'}), 400
         
-        # Get room data
-        room_ref = db.collection('rooms').document(room_key)
-        room = room_ref.get()
+        # Turn away known-bad tokens without reading the room
+        if token_index.rejects(room_key, player_token):
+            return jsonify({'error': 'Invalid player token'}), 403
+        
+        # Only read from here on, so share the cached room instead of copying it
+        room_data = store.snapshot(room_key)
         
-        if not room.exists:
+        if room_data is None:
             return jsonify({'error': 'Room not found'}), 404
             
-        room_data = room.to_dict()
-        
-        # Find the player's index based on the token
-        players = room_data.get('players', [])
-        player_idx = None
-        opponent_idx = None
-        
-        for i, player in enumerate(players):
-            if player.get('token') == player_token:
-                player_idx = i
-                opponent_idx = 1 if i == 0 else 0
-                break
-                    
+        player_idx = find_player(room_data, player_token)
         if player_idx is None:
             return jsonify({'error': 'Invalid player token'}), 403
-                
-        # Get player and opponent data
-        player_data = players[player_idx] if player_idx < len(players) else {}
-        opponent_data = players[opponent_idx] if opponent_idx < len(players) else {}
+            
+        # The view only changes when the room version does, so a client that
+        # already has this version gets a 304 without anything being rebuilt
+        etag = f"{room_data.get('version', 0)}-{player_idx + 1}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(view_builder.body(room_key, room_data, player_idx), mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # Always revalidate
+        return response
         
-        return jsonify({
-            'player_field': player_data.get('field', []),
-            'opponent_field': opponent_data.get('field', []),
-            'player_hand': player_data.get('hand', []),
-            'opponent_hand_count': len(opponent_data.get('hand', [])),
-            'player_score': player_data.get('score', 0),
-            'opponent_score': opponent_data.get('score', 0),
-            'current_turn': room_data.get('current_turn'),
-            'game_state': room_data.get('game_state', 'unknown'),
-            'your_turn': room_data.get('current_turn') == player_idx + 1
-        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/render_info/wait', methods=['GET'])
+def wait_render_info():
+    """Long-poll for the next change to the game state.
+    
+    Holds the request until the room's version is newer than since_version
+    or timeout seconds pass, then answers like render_info. If nothing
+    changed, the response is {'changed': False, 'version': since_version}
+    and the client simply asks again.
+    """
+    try:
+        room_key = request.args.get('room_key')
+        player_token = request.args.get('player_token')
+        since_version = request.args.get('since_version', -1, type=int)
+        timeout = min(request.args.get('timeout', LONG_POLL_TIMEOUT, type=float), LONG_POLL_TIMEOUT)
+        
+        if not all([room_key, player_token]):
+            return jsonify({'error': 'Missing required parameters (room_key, player_token)'}), 400
+        if token_index.rejects(room_key, player_token):
+            return jsonify({'error': 'Invalid player token'}), 403
+        
+        deadline = time.monotonic() + timeout
+        # Listen before reading so a write in between still wakes us up
+        with room_events.listen(room_key) as listener:
+            while True:
+                room_data = store.snapshot(room_key)
+                if room_data is None:
+                    return jsonify({'error': 'Room not found'}), 404
+                    
+                if room_data.get('version', 0) > since_version:
+                    response, status_code = player_view(room_data, player_token, room_key)
+                    return jsonify(dict(response, changed=True) if status_code == 200 else response), status_code
+                    
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not listener.wait(remaining):
+                    # Still check the token so bad clients can't park here for free
+                    response, status_code = player_view(room_data, player_token, room_key)
+                    if status_code != 200:
+                        return jsonify(response), status_code
+                    return jsonify({'changed': False, 'version': since_version})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/render_info/stream', methods=['GET'])
+def stream_render_info():
+    """Stream the game state to one player as Server-Sent Events.
+    
+    A 'state' event carrying the render_info view is sent on connect and
+    after every change to the room, with the room version as the event id.
+    Comment lines keep idle connections open. The stream ends after
+    STREAM_MAX_DURATION seconds; EventSource reconnects on its own and
+    resumes from Last-Event-ID.
+    """
+    room_key = request.args.get('room_key')
+    player_token = request.args.get('player_token')
+    last_version = request.headers.get('Last-Event-ID', type=int)
+    if last_version is None:
+        last_version = request.args.get('since_version', -1, type=int)
+    
+    if not all([room_key, player_token]):
+        return jsonify({'error': 'Missing required parameters (room_key, player_token)'}), 400
+    if token_index.rejects(room_key, player_token):
+        return jsonify({'error': 'Invalid player token'}), 403
+    
+    # Reject bad requests with a normal error before starting the stream
+    room_data = store.snapshot(room_key)
+    if room_data is None:
+        return jsonify({'error': 'Room not found'}), 404
+    response, status_code = player_view(room_data, player_token, room_key)
+    if status_code != 200:
+        return jsonify(response), status_code
+    
+    def generate(last_version):
+        deadline = time.monotonic() + STREAM_MAX_DURATION
+        # after_request has already run when the stream starts, so label
+        # the stream's storage spans here
+        with label_route(metrics, '/render_info/stream'), room_events.listen(room_key) as listener:
+            while time.monotonic() < deadline:
+                room_data = store.snapshot(room_key)
+                if room_data is None:
+                    yield 'event: error\ndata: {"error": "Room not found"}\n\n'
+                    return
+                version = room_data.get('version', 0)
+                if version != last_version:
+                    response, status_code = player_view(room_data, player_token, room_key)
+                    if status_code != 200:
+                        yield f'event: error\ndata: {json.dumps(response)}\n\n'
+                        return
+                    yield f'id: {version}\nevent: state\ndata: {json.dumps(response)}\n\n'
+                    last_version = version
+                if not listener.wait(STREAM_HEARTBEAT):
+                    yield ': keep-alive\n\n'
+    
+    return Response(generate(last_version), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Don't let proxies buffer the stream
+    })
+
+def play_turn(room_data, player_token, action, card_index):
+    """Work out the outcome of a player_action request on one room state.
+    
+    Args:
+        room_data: The room data dictionary (not modified)
+        player_token: The player's authentication token
+        action: 'play' or 'draw'
+        card_index: Index of the card to play, or -1 to pass
+        
+    Returns:
+        tuple: (updates, (response, status_code)) where updates holds the
+               fields to write, or None if nothing changes
+    """
+    player, error_response, status_code = verify_player_turn(room_data, player_token)
+    if error_response:
+        return None, (error_response, status_code)
+        
+    players = room_data.get('players', [])
+    if player < 1 or player > len(players):
+        return None, ({'error': 'Invalid player number'}, 400)
+        
+    state = GameState.from_room(room_data)
+    
+    # Check for win condition at the start of turn
+    if state.scores[player - 1] >= WINNING_SCORE:
+        return None, ({
+            'game_over': True,
+            'winner': player,
+            'message': f'Player {player} wins with {state.scores[player - 1]} points!',
+            'scores': {
+                'player_1': state.scores[0],
+                'player_2': state.scores[1]
+            }
+        }, 200)
+        
+    # card_index -1 means passing the turn
+    if action == 'play':
+        engine_action = Action(PASS) if card_index == -1 else Action(PLAY, card_index)
+    elif action == 'draw' and card_index == -1:
+        engine_action = Action(DRAW)
+    else:
+        return None, ({'error': f'Invalid action: {action}'}, 400)
+        
+    try:
+        outcome = step(state, engine_action)
+    except IllegalMove as e:
+        return None, ({'error': str(e)}, 400)
+    updates = state.room_updates(room_data)
+    player_hand = state.hands[player - 1]
+    
+    if engine_action.kind == PASS:
+        if outcome.needs_discard:
+            return updates, ({
+                'success': False,
+                'message': f'Discard {outcome.needs_discard} card(s) down to 4',
+                'needs_discard': True,
+                'hand_size': len(player_hand),
+                'cards_to_discard': outcome.needs_discard,
+                'current_game_state': state.phase
+            }, 200)
+        return updates, ({
+            'success': True,
+            'message': 'Turn passed',
+            'player_num': player
+        }, 200)
+        
+    if engine_action.kind == PLAY:
+        return updates, ({
+            'success': True,
+            'card_played': card_info(outcome.played),
+            'player_num': player,
+            'updated_hand': expand_cards(player_hand)
+        }, 200)
+        
+    if outcome.discarded:
+        message = f'Drew {len(outcome.drawn)} card(s) and discarded {len(outcome.discarded)} excess card(s)'
+    else:
+        message = f'Drew {len(outcome.drawn)} card(s)' if outcome.drawn else 'No cards to draw'
+    return updates, ({
+        'success': True,
+        'message': message,
+        'updated_hand': expand_cards(player_hand),
+        'updated_field': expand_cards(state.fields[player - 1]),
+        'card_effect': None,
+        'drawn_card': None
+    }, 200)
+
 @app.route('/player_action', methods=['GET'])
 def player_action():
     """Handle player actions (playing a card)."""
@@ -353,7 +616,8 @@ def player_action():
         # Ensure card_index is an integer
         card_index = int(card_index) if card_index is not None else -1
         
-        print(f"Received request with params - room_key: {room_key}, player_token: {player_token}, action: {action}, card_index: {card_index}")
+        log_event(log, logging.DEBUG, 'player_action.request', sample='player_action', room_key=room_key,
+                  player_token=player_token, action=action, card_index=card_index)
         
         # Check for required parameters
         if not all([room_key, player_token, action]):
@@ -372,170 +636,61 @@ def player_action():
             except ValueError:
                 return jsonify({'error': 'card_index must be an integer'}), 400
         
-        # Get room data
-        room_ref = db.collection('rooms').document(room_key)
-        room = room_ref.get()
-        
-        if not room.exists:
-            return jsonify({'error': 'Room not found'}), 404
-            
-        room_data = room.to_dict()
-        
-        player, error_response, status_code = verify_player_turn(room_data, player_token)
-        if error_response:
-            return jsonify(error_response), status_code
+        # Turn away known-bad tokens without reading the room
+        if token_index.rejects(room_key, player_token):
+            return jsonify({'error': 'Invalid player token'}), 403
             
-        # Check for win condition at the start of turn
-        player_score = room_data.get(f'player_{player}_score', 0)
-        if player_score >= 7:
-            return jsonify({
-                'game_over': True,
-                'winner': player,
-                'message': f'Player {player} wins with {player_score} points!',
-                'scores': {
-                    'player_1': players[0].get('score', 0),
-                    'player_2': players[1].get('score', 0)
-                }
-            }), 200
+        # Apply the turn as a single conditional write on the room's shard,
+        # retried if the room changed underneath us
+        room_data, result = run_move(
+            room_key,
+            lambda room_data: play_turn(room_data, player_token, action, card_index)
+        )
         
-        # Get player data
-        players = room_data.get('players', [])
-        if player < 1 or player > len(players):
-            return jsonify({'error': 'Invalid player number'}), 400
+        if room_data is None:
+            return jsonify({'error': 'Room not found'}), 404
             
-        player_data = players[player - 1]
-        
-        # Create copies to work with
-        player_hand = player_data.get('hand', []).copy()
-        player_field = player_data.get('field', []).copy()
+        response, status_code = result
+        return jsonify(response), status_code
         
-        # Handle play action
-        if action == 'play':
-            # Handle pass turn (card_index = -1)
-            if card_index == -1:
-                # Check if player has 5 or 6 cards
-                if len(player_hand) in [5, 6]:
-                    cards_to_discard = len(player_hand) - 4
-                    # Update the game state in the database
-                    room_ref.set({
-                        'game_state': 'player_discard'
-                    }, merge=True)
-                    # Get the updated room data
-                    room_data = room_ref.get().to_dict()
-                    return jsonify({
-                        'success': False,
-                        'message': f'Discard {cards_to_discard} card(s) down to 4',
-                        'needs_discard': True,
-                        'hand_size': len(player_hand),
-                        'cards_to_discard': cards_to_discard,
-                        'current_game_state': room_data.get('game_state', 'unknown')
-                    })
-                # If not, just switch turns
-                room_ref.update({
-                    'current_turn': 2 if room_data['current_turn'] == 1 else 1,
-                    'game_state': 'player_action'
-                })
-                return jsonify({
-                    'success': True,
-                    'message': 'Turn passed',
-                    'player_num': player
-                })
-            
-            # Handle playing a card
-            if card_index < 0 or card_index >= len(player_hand):
-                return jsonify({'error': 'Invalid card selection'}), 400
-            
-            # Get the selected card and ensure it has an image field
-            card = player_hand.pop(card_index)
-            if 'image' not in card:
-                card['image'] = ''
-            
-            # Add to field
-            if 'field' not in player_data:
-                player_data['field'] = []
-            player_data['field'].append(card)
-            
-            # Update player data
-            players[player - 1] = player_data
-            
-            # Prepare updates
-            updates = {
-                'players': players,
-                'current_turn': 2 if player == 1 else 1,  # Switch turns
-                'game_state': 'player_action'
-            }
-            
-            room_ref.update(updates)
-            
-            return jsonify({
-                'success': True,
-                'card_played': card,
-                'player_num': player,
-                'updated_hand': player_hand
-            })
-        # Handle draw cards if action is draw
-        elif action == 'draw' and card_index == -1:
-            # Get the current deck and discard pile
-            deck = room_data.get('deck', []).copy()
-            discard_pile = room_data.get('discard_pile', [])
-            
-            # Draw up to 2 cards if available
-            drawn_cards = []
-            for _ in range(2):
-                if deck:
-                    card = deck.pop()
-                    if 'image' not in card:
-                        card['image'] = ''
-                    drawn_cards.append(card)
-                # If deck is empty but there are cards in discard pile, shuffle them into the deck
-                elif not deck and discard_pile:
-                    deck = [card for card in discard_pile if isinstance(card, dict)]
-                    random.shuffle(deck)
-                    discard_pile = []
-                    if deck:  # If we managed to refill the deck
-                        card = deck.pop()
-                        if 'image' not in card:
-                            card['image'] = ''
-                        drawn_cards.append(card)
-            
-            # Update player's hand with drawn cards
-            player_hand.extend(drawn_cards)
-            
-            # If player has more than 4 cards, automatically discard excess
-            if len(player_hand) > 4:
-                # Calculate how many cards to discard
-                excess = len(player_hand) - 4
-                discarded = player_hand[-excess:]  # Take from the end (newest cards)
-                player_hand = player_hand[:-excess]  # Keep the rest
-                # Add discarded cards to bottom of deck
-                deck = discarded + deck
-                message = f'Drew {len(drawn_cards)} card(s) and discarded {len(discarded)} excess card(s)'
-            else:
-                message = f'Drew {len(drawn_cards)} card(s)' if drawn_cards else 'No cards to draw'
-            
-            # Update player's hand and game state
-            players[player - 1]['hand'] = player_hand
-            updates = {
-                'players': players,
-                'deck': deck,
-                'discard_pile': discard_pile,
-                'current_turn': 2 if player == 1 else 1,  # Switch turns
-                'game_state': 'player_action'
-            }
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def discard_turn(room_data, player_token, card_indices):
+    """Work out the outcome of a discard_cards request on one room state.
+    
+    Args:
+        room_data: The room data dictionary (not modified)
+        player_token: The player's authentication token
+        card_indices: Indices of the hand cards to discard
         
-        room_ref.update(updates)
+    Returns:
+        tuple: (updates, (response, status_code)) where updates holds the
+               fields to write, or None if nothing changes
+    """
+    player, error_response, status_code = verify_player_turn(room_data, player_token, 'player_discard')
+    if error_response:
+        return None, (error_response, status_code)
         
-        response = {
-            'success': True,
-            'updated_hand': player_hand,
-            'updated_field': player_field,
-            'card_effect': 'draw_1' if card.get('value') == 2 and drawn_card is not None else None,
-            'drawn_card': drawn_card if card.get('value') == 2 and drawn_card is not None else None
-        }
-        return jsonify(response)
+    players = room_data.get('players', [])
+    if player < 1 or player > len(players):
+        return None, ({'error': 'Invalid player number'}, 400)
         
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    state = GameState.from_room(room_data)
+    try:
+        outcome = step(state, Action(DISCARD, card_indices=tuple(card_indices)))
+    except IllegalMove as e:
+        return None, ({'error': str(e)}, 400)
+        
+    return state.room_updates(room_data), ({
+        'success': True,
+        'message': f'Discarded {len(outcome.discarded)} and drew {len(outcome.drawn)} card(s). Turn ended.',
+        'drawn_cards': len(outcome.drawn),
+        'new_hand_size': len(state.hands[player - 1]),
+        'new_deck_size': len(state.deck),
+        'turn_ended': True,
+        'next_player': state.current_turn
+    }, 200)
 
 @app.route('/discard_cards', methods=['GET'])
 def discard_cards():
@@ -552,97 +707,20 @@ def discard_cards():
         # Validate parameters
         if not all([room_id, player_token]):
             return jsonify({'error': 'Missing required parameters'}), 400
+        if token_index.rejects(room_id, player_token):
+            return jsonify({'error': 'Invalid player token'}), 403
             
-        # Get room data to check current hand size
-        room_ref = db.collection('rooms').document(room_id)
-        room = room_ref.get()
+        # Apply the discard as a single conditional write on the room's shard
+        room_data, result = run_move(
+            room_id,
+            lambda room_data: discard_turn(room_data, player_token, card_indices)
+        )
         
-        if not room.exists:
+        if room_data is None:
             return jsonify({'error': 'Room not found'}), 404
             
-        room_data = room.to_dict()
-        
-        # Get current player's hand size
-        player, error_response, status_code = verify_player_turn(room_data, player_token, 'player_discard')
-        if error_response:
-            return jsonify(error_response), status_code
-            
-        players = room_data.get('players', [])
-        if player < 1 or player > len(players):
-            return jsonify({'error': 'Invalid player number'}), 400
-            
-        player_hand = players[player - 1].get('hand', [])
-        hand_size = len(player_hand)
-        
-        # Determine required discards based on hand size
-        required_discards = 1 if hand_size == 5 else 2 if hand_size == 6 else 0
-        
-        if required_discards == 0:
-            return jsonify({'error': 'No discards needed'}), 400
-            
-        # Validate number of cards being discarded
-        if len(card_indices) != required_discards:
-            return jsonify({'error': f'You must discard exactly {required_discards} card(s)'}), 400
-            
-        # Get player data and deck
-        player_data = players[player - 1]
-        player_hand = players[player - 1].get('hand', []).copy()
-        deck = room_data.get('deck', []).copy()
-        discard_pile = room_data.get('discard_pile', [])
-        
-        # Validate card indices
-        if not all(isinstance(idx, int) and 0 <= idx < len(player_hand) for idx in card_indices):
-            return jsonify({'error': 'One or more invalid card indices'}), 400
-            
-        # Remove cards from hand (in reverse order to maintain indices)
-        discarded_cards = []
-        for idx in sorted(card_indices, reverse=True):
-            discarded_cards.append(player_hand.pop(idx))
-        
-        # Add discarded cards to bottom of deck
-        deck = discarded_cards + deck
-        
-        # Draw 2 cards
-        drawn_cards = []
-        for _ in range(2):
-            if deck:
-                drawn_cards.append(deck.pop())
-            elif discard_pile:  # If deck is empty but there are cards in discard pile
-                # Reshuffle discard pile into deck
-                deck = discard_pile.copy()
-                import random
-                random.shuffle(deck)
-                discard_pile = []
-                if deck:  # If we managed to refill the deck
-                    drawn_cards.append(deck.pop())
-        
-        # Add drawn cards to player's hand
-        player_hand.extend(drawn_cards)
-        players[player - 1]['hand'] = player_hand
-        
-        # Switch turns
-        new_turn = 2 if room_data.get('current_turn') == 1 else 1
-        
-        # Update the room with the new state
-        updates = {
-            'players': players,
-            'deck': deck,
-            'discard_pile': discard_pile,
-            'game_state': 'player_action',
-            'current_turn': new_turn  # Switch turns
-        }
-        room_ref.set(updates, merge=True)
-        
-        # Return success response
-        return jsonify({
-            'success': True,
-            'message': f'Discarded {len(discarded_cards)} and drew {len(drawn_cards)} card(s). Turn ended.',
-            'drawn_cards': len(drawn_cards),
-            'new_hand_size': len(player_hand),
-            'new_deck_size': len(deck),
-            'turn_ended': True,
-            'next_player': new_turn
-        })
+        response, status_code = result
+        return jsonify(response), status_code
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -653,16 +731,22 @@ def get_scores(room_id):
     """Get current scores for both players."""
     try:
         # Get room data
-        room_ref = db.collection('rooms').document(room_id)
-        room = room_ref.get()
+        room_data = store.snapshot(room_id)
         
-        if not room.exists:
+        if room_data is None:
             return jsonify({'error': 'Room not found'}), 404
             
-        room_data = room.to_dict()
+        # Scores and state only change with the room version
+        etag = f"scores-{room_data.get('version', 0)}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'  # Always revalidate
+            return response
+            
         players = room_data.get('players', [])
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'scores': {
                 'player_1': players[0].get('score', 0) if len(players) > 0 else 0,
@@ -670,6 +754,9 @@ def get_scores(room_id):
             },
             'game_state': room_data.get('game_state')
         })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # Always revalidate
+        return response
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -730,4 +817,4 @@ if __name__ == '__main__':
     # Run the test function
     test_filter_game_data()
     # Start the Flask app
-    app.run(debug=True, port=5000)
+    create_app().run(debug=True, port=5000)
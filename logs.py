@@ -0,0 +1,148 @@
+"""Structured logging that keeps I/O off the request threads.
+
+Request handlers call log_event(), which builds a record only if the level
+is enabled (and the event survives sampling), redacts tokens, and puts it
+on a queue. A QueueListener thread turns records into JSON lines and writes
+them, so a slow stdout never blocks a request.
+
+Configured from the environment:
+
+    LOG_LEVEL   DEBUG, INFO (default), WARNING, ...
+                DEBUG shows every request's parameters, as the old prints did
+    LOG_SAMPLE  Fraction of events to keep per sample key, for example
+                render_info=0.01,player_action=0.1. Events without a sample
+                key, and warnings and errors, are always kept.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+LOGGER_NAME = 'game'
+# Field names whose values are never logged in full
+REDACTED_FIELDS = ('token', 'player_token', 'first_player_token', 'second_player_token')
+# Characters of a token kept so log lines can still be correlated
+REDACTED_PREFIX = 4
+
+_sample_rates = {}
+_listener = None
+
+
+def get_logger(name=None):
+    """Return the app logger, or a child of it."""
+    return logging.getLogger(f'{LOGGER_NAME}.{name}' if name else LOGGER_NAME)
+
+
+def redact(value):
+    """Return value with every token field shortened to a short prefix."""
+    if isinstance(value, dict):
+        return {
+            key: _redact_token(item) if key in REDACTED_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def _redact_token(token):
+    if not isinstance(token, str):
+        return token
+    return token[:REDACTED_PREFIX] + '...'
+
+
+def log_event(logger, level, event, sample=None, **fields):
+    """Log a structured event.
+
+    Args:
+        logger: Logger from get_logger()
+        level: logging level, e.g. logging.DEBUG
+        event: Short event name, used as the message
+        sample: Optional sample key. Events below WARNING are kept with the
+            probability LOG_SAMPLE gives for this key.
+        **fields: Values to include. Tokens are redacted and everything is
+            copied here, so later changes to the objects don't show up.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample is not None and level < logging.WARNING:
+        rate = _sample_rates.get(sample, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+    logger.log(level, event, extra={'fields': redact(fields)})
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                    + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The base class formats the message here, on the request thread.
+        # Only resolve %-style arguments and leave the JSON to the listener.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(spec):
+    """Parse 'key=rate,key=rate' into a dict of floats."""
+    rates = {}
+    for part in filter(None, (item.strip() for item in spec.split(','))):
+        key, _, rate = part.partition('=')
+        rates[key.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(level=None, sample_rates=None, stream=None):
+    """Send the app logger through a queue to a JSON handler on a background thread.
+
+    Safe to call more than once; later calls only change the level and
+    sample rates.
+
+    Args:
+        level: Log level name or number. Defaults to $LOG_LEVEL, then INFO.
+        sample_rates: sample key -> fraction kept. Defaults to $LOG_SAMPLE.
+        stream: Where log lines go. Defaults to stdout.
+    """
+    global _listener
+    logger = get_logger()
+    logger.setLevel(level or os.environ.get('LOG_LEVEL', 'INFO').upper())
+    _sample_rates.clear()
+    _sample_rates.update(
+        sample_rates if sample_rates is not None else parse_sample_rates(os.environ.get('LOG_SAMPLE', ''))
+    )
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JSONFormatter())
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_QueueHandler(log_queue))
+    logger.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(_listener.stop)
@@ -0,0 +1,279 @@
+"""Request and storage metrics in Prometheus text format.
+
+Turned on with METRICS=1. The app then serves /metrics with:
+
+    http_requests_total{route, method, status}   counter
+    http_request_duration_seconds{route}         histogram
+    span_duration_seconds{route, span}           histogram
+
+Spans time each storage call (storage.get, storage.snapshot, storage.create,
+storage.set, storage.update, storage.diff) and each JSON serialization (serialize) and
+are labelled with the route that made them, so a slow player_action can be
+split into store reads, writes, serialization and the remainder, which is
+the game logic.
+
+A streamed response (/render_info/stream) is counted and timed when it
+starts; the storage reads it makes while streaming are still labelled with
+its route. The ASGI server's native routes are measured the same way.
+
+When METRICS is off nothing is wrapped or registered, so the only cost left
+is one None check in after_request.
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+from storage import RoomStoreWrapper
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative Prometheus histogram. Not thread-safe on its own."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe_span(self.name, time.perf_counter() - self.started)
+
+
+class _Route:
+    __slots__ = ('local', 'name', 'previous')
+
+    def __init__(self, local, name):
+        self.local = local
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(self.local, 'route', None)
+        self.local.route = self.name
+        return self
+
+    def __exit__(self, *exc_info):
+        self.local.route = self.previous
+
+
+class Metrics:
+    """Collects request counters and latency histograms for one process."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._requests = {}   # (route, method, status) -> count
+        self._durations = {}  # route -> Histogram
+        self._spans = {}      # (route, span) -> Histogram
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def span(self, name):
+        """Time a block of code as a span of the current request.
+
+        Use as a context manager: with metrics.span('storage.get'): ...
+        """
+        return _Span(self, name)
+
+    def route(self, name):
+        """Label the spans timed on this thread with route name within a block.
+
+        For work done outside Flask's request hooks, e.g. a streaming
+        response's generator or the ASGI server's native routes.
+        """
+        return _Route(self._local, name)
+
+    def observe_span(self, name, seconds):
+        key = (getattr(self._local, 'route', None) or 'none', name)
+        with self._lock:
+            histogram = self._spans.get(key)
+            if histogram is None:
+                histogram = self._spans[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def start_request(self):
+        """Remember the route and start time of the request on this thread."""
+        rule = request.url_rule
+        self._local.route = rule.rule if rule is not None else 'unmatched'
+        self._local.started = time.perf_counter()
+
+    def finish_request(self, response):
+        """Count the request and record its duration. Called from after_request."""
+        started = getattr(self._local, 'started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        route = self._local.route
+        self._local.route = self._local.started = None
+        self.observe_request(route, request.method, response.status_code, seconds)
+
+    def observe_request(self, route, method, status, seconds):
+        """Count one request and record its duration."""
+        key = (route, method, status)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._durations.get(route)
+            if histogram is None:
+                histogram = self._durations[route] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            durations = [(route, _snapshot(h)) for route, h in sorted(self._durations.items())]
+            spans = [(key, _snapshot(h)) for key, h in sorted(self._spans.items())]
+
+        lines = [
+            '# HELP http_requests_total Requests handled, by route, method and status.',
+            '# TYPE http_requests_total counter',
+        ]
+        for (route, method, status), count in requests:
+            lines.append(f'http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+
+        lines += [
+            '# HELP http_request_duration_seconds Time spent handling requests, by route.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for route, histogram in durations:
+            lines += self._histogram_lines('http_request_duration_seconds', histogram, route=route)
+
+        lines += [
+            '# HELP span_duration_seconds Time spent in storage calls and serialization, by route and span.',
+            '# TYPE span_duration_seconds histogram',
+        ]
+        for (route, name), histogram in spans:
+            lines += self._histogram_lines('span_duration_seconds', histogram, route=route, span=name)
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, name, histogram, **labels):
+        counts, total, count = histogram
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_labels(le=repr(bound), **labels)} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(le="+Inf", **labels)} {count}')
+        lines.append(f'{name}_sum{_labels(**labels)} {total!r}')
+        lines.append(f'{name}_count{_labels(**labels)} {count}')
+        return lines
+
+
+def _snapshot(histogram):
+    return list(histogram.counts), histogram.sum, histogram.count
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class InstrumentedRoomStore(RoomStoreWrapper):
+    """RoomStore wrapper that times every call as a storage span."""
+
+    def __init__(self, backend, metrics):
+        super().__init__(backend)
+        self.metrics = metrics
+
+    def get(self, room_key, **kwargs):
+        with self.metrics.span('storage.get'):
+            return self.backend.get(room_key, **kwargs)
+
+    def snapshot(self, room_key):
+        with self.metrics.span('storage.snapshot'):
+            return self.backend.snapshot(room_key)
+
+    def create(self, room_key, room_data):
+        with self.metrics.span('storage.create'):
+            self.backend.create(room_key, room_data)
+
+    def set(self, room_key, room_data):
+        with self.metrics.span('storage.set'):
+            self.backend.set(room_key, room_data)
+
+    def update(self, room_key, updates, expected_version=None):
+        with self.metrics.span('storage.update'):
+            self.backend.update(room_key, updates, expected_version=expected_version)
+
+    def diff(self, room_key, room_data, updates):
+        with self.metrics.span('storage.diff'):
+            return self.backend.diff(room_key, room_data, updates)
+
+
+class _TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that times serialization as a span."""
+
+    metrics = None
+
+    def dumps(self, obj, **kwargs):
+        with self.metrics.span('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+def create_metrics():
+    """Return a Metrics collector if $METRICS enables it, otherwise None."""
+    if os.environ.get('METRICS', '0').lower() in ('', '0', 'false', 'no', 'off'):
+        return None
+    return Metrics()
+
+
+def label_route(metrics, route):
+    """metrics.route(route), or a no-op block if metrics are disabled."""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.route(route)
+
+
+def wrap_with_metrics(store, metrics):
+    """Time every call to store, if metrics are enabled."""
+    if metrics is None:
+        return store
+    return InstrumentedRoomStore(store, metrics)
+
+
+def init_app(app, metrics):
+    """Start timing requests and JSON serialization and add the /metrics route.
+
+    The app's after_request hook must call metrics.finish_request(response).
+    Does nothing if metrics is None.
+    """
+    if metrics is None:
+        return
+
+    app.before_request(metrics.start_request)
+
+    provider = _TimedJSONProvider(app)
+    provider.metrics = metrics
+    app.json = provider
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Expose the collected metrics to Prometheus."""
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
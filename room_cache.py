@@ -0,0 +1,283 @@
+"""In-process write-through cache of room state.
+
+Rooms are served from memory for at most ROOM_CACHE_MAX_AGE seconds after
+they were last read from or written to the backing store. Writes made by
+other server processes are therefore seen within that time; when a single
+process owns each room (one worker, or the ROOM_SHARD_NODES ring) nothing
+else writes it, and the limit can be raised or set to inf. Long-polls and
+streams are only woken by writes made in this process, so a change made
+elsewhere reaches them on their next read, after the poll timeout or
+stream heartbeat.
+
+Every write through the cache bumps the room's 'version' field, which lets
+callers detect stale copies and lets the cache refetch a room when someone
+asks for a newer version than the one it holds.
+"""
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from storage import RoomStoreWrapper, VersionConflict, set_path
+
+class _Entry:
+    __slots__ = ('data', 'version', 'fetched', 'last_access')
+
+    def __init__(self, data, version, now):
+        self.data = data
+        self.version = version
+        self.fetched = now
+        self.last_access = now
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Callers that arrive while a call for their key is in flight wait for it
+    and share its result (or exception) instead of making their own call.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Return func(), or the result of the call for key already in flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class CachedRoomStore(RoomStoreWrapper):
+    """LRU cache with idle TTL and maximum age in front of another RoomStore.
+
+    Reads are served from memory on a hit. The backing store is only read on
+    a miss, once the entry has been idle for ttl seconds or held for max_age
+    seconds, or when the caller asks for a version newer than the cached
+    one, and concurrent misses for the same room share one read. Conditional writes go to the backing store first and then
+    replace the cached entry. Unconditional writes drop it instead: their
+    result depends on what the store held at the time, which may differ
+    from the cached copy.
+    """
+
+    def __init__(self, backend, max_rooms=10000, ttl=3600, max_age=1.0, clock=time.monotonic):
+        super().__init__(backend)
+        self.max_rooms = max_rooms
+        self.ttl = ttl
+        self.max_age = max_age
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._reads = SingleFlight()
+        # Bumped by every invalidate(), so a read that was in flight at the
+        # time doesn't put the dropped state back
+        self._invalidations = 0
+
+    def get(self, room_key, min_version=None):
+        """Return the room data, reading the backing store only if needed.
+
+        Args:
+            room_key: Key of the room to read
+            min_version: Optional version the caller knows exists. A cached
+                entry older than this is treated as a miss.
+
+        Returns:
+            dict: A private copy of the room data, or None if it does not exist
+        """
+        room_data = self._read(room_key, min_version)
+        return copy.deepcopy(room_data) if room_data is not None else None
+
+    def snapshot(self, room_key):
+        """Return the cached room data itself, without copying it.
+
+        Entries are replaced on every write, never changed in place, so the
+        result stays a consistent picture of one version.
+        """
+        return self._read(room_key)
+
+    def _read(self, room_key, min_version=None):
+        """Return the cached data for room_key, fetching it if needed."""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(room_key)
+            if entry is not None and not self._expired(entry, now) and now - entry.fetched <= self.max_age:
+                if min_version is None or entry.version >= min_version:
+                    entry.last_access = now
+                    self._entries.move_to_end(room_key)
+                    return entry.data
+
+        # Polls of the same room arriving together share one backend read
+        room_data = self._reads.do(room_key, lambda: self._fetch(room_key))
+        if room_data is not None and min_version is not None and room_data.get('version', 0) < min_version:
+            # Joined a read that started before that version was written
+            room_data = self._fetch(room_key)
+        return room_data
+
+    def _fetch(self, room_key):
+        """Read a room from the backing store into the cache.
+
+        Returns the cached data itself, which must not be modified.
+        """
+        with self._lock:
+            invalidations = self._invalidations
+        room_data = self.backend.get(room_key)
+        if room_data is None:
+            self.invalidate(room_key)
+            return None
+        return self._store(room_key, room_data, copied=True, only_if_newer=True, invalidations=invalidations)
+
+    def create(self, room_key, room_data):
+        room_data = dict(room_data)
+        room_data['version'] = room_data.get('version', 0) + 1
+        self.backend.create(room_key, room_data)
+        self._store(room_key, room_data)
+
+    def set(self, room_key, room_data):
+        room_data = dict(room_data)
+        room_data['version'] = room_data.get('version', 0) + 1
+        self.backend.set(room_key, room_data)
+        self._store(room_key, room_data)
+
+    def update(self, room_key, updates, expected_version=None):
+        if expected_version is None:
+            # The store bumps the version of whatever it holds, which may be
+            # newer than our copy, so read the result back when next asked
+            try:
+                self.backend.update(room_key, updates)
+            finally:
+                self.invalidate(room_key)
+            return
+
+        with self._lock:
+            entry = self._entries.get(room_key)
+            current = entry.data if entry is not None else None
+        if current is None:
+            current = self.backend.get(room_key)
+            if current is None:
+                raise KeyError(f'Room {room_key} does not exist')
+        if current.get('version', 0) != expected_version:
+            # The room already moved past the version the caller read
+            raise VersionConflict(room_key)
+
+        # The write only succeeds if the store still holds expected_version,
+        # which is exactly the state current describes
+        updates = dict(updates)
+        updates.setdefault('version', expected_version + 1)
+        try:
+            self.backend.update(room_key, updates, expected_version=expected_version)
+        except VersionConflict:
+            # Someone else wrote the room, so our copy is stale too
+            self.invalidate(room_key)
+            raise
+
+        room_data = copy.deepcopy(current)
+        for path, value in updates.items():
+            set_path(room_data, path, copy.deepcopy(value))
+        self._store(room_key, room_data, copied=True)
+
+    def invalidate(self, room_key):
+        """Drop a room from the cache so the next read goes to the backing store."""
+        with self._lock:
+            self._entries.pop(room_key, None)
+            self._invalidations += 1
+
+    def _store(self, room_key, room_data, copied=False, only_if_newer=False, invalidations=None):
+        """Cache room_data and return the cached data.
+
+        With only_if_newer, a cached entry with a higher version (written
+        while room_data was being read) is kept instead. If invalidations is
+        given and invalidate() ran since, room_data is returned uncached.
+        """
+        now = self._clock()
+        if not copied:
+            room_data = copy.deepcopy(room_data)
+        entry = _Entry(room_data, room_data.get('version', 0), now)
+        with self._lock:
+            if invalidations is not None and invalidations != self._invalidations:
+                return room_data
+            current = self._entries.get(room_key)
+            if only_if_newer and current is not None and current.version > entry.version:
+                return current.data
+            self._entries[room_key] = entry
+            self._entries.move_to_end(room_key)
+            self._evict(now)
+        return room_data
+
+    def _expired(self, entry, now):
+        return now - entry.last_access > self.ttl
+
+    def _evict(self, now):
+        """Drop expired rooms and trim to max_rooms. Must be called with the lock held."""
+        # Entries are ordered by last access, so idle rooms sit at the front
+        while self._entries:
+            room_key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_rooms and not self._expired(entry, now):
+                break
+            del self._entries[room_key]
+
+
+def wrap_with_cache(backend):
+    """Put a CachedRoomStore in front of backend, configured from the environment.
+
+    ROOM_CACHE=0 disables the cache, keeping only the sharing of concurrent
+    reads. ROOM_CACHE_SIZE and ROOM_CACHE_TTL set the maximum number of
+    cached rooms and the idle time in seconds before a room is dropped, and
+    ROOM_CACHE_MAX_AGE the seconds a room is served before it is read again.
+    """
+    if os.environ.get('ROOM_CACHE', '1') == '0':
+        return CoalescingRoomStore(backend)
+    return CachedRoomStore(
+        backend,
+        max_rooms=int(os.environ.get('ROOM_CACHE_SIZE', 10000)),
+        ttl=float(os.environ.get('ROOM_CACHE_TTL', 3600)),
+        max_age=float(os.environ.get('ROOM_CACHE_MAX_AGE', 1.0)),
+    )
+
+
+class CoalescingRoomStore(RoomStoreWrapper):
+    """Shares concurrent reads of the same room without caching anything.
+
+    Used instead of CachedRoomStore when the cache is turned off, so a burst
+    of polls for one room still costs one backend read.
+    """
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self._reads = SingleFlight()
+
+    def get(self, room_key):
+        room_data = self.snapshot(room_key)
+        # Every caller may modify what it gets back, so each gets its own copy
+        return copy.deepcopy(room_data) if room_data is not None else None
+
+    def snapshot(self, room_key):
+        return self._reads.do(room_key, lambda: self.backend.get(room_key))
@@ -0,0 +1,181 @@
+"""Change notifications for rooms written by this process.
+
+Long-poll and streaming endpoints wait here instead of re-reading the room
+on a timer. Every write that goes through a NotifyingRoomStore wakes the
+requests waiting on that room, which then read the new state (normally from
+the room cache) and send it to the player.
+
+Async servers use listen_async(), which wakes an asyncio task instead of
+blocking a thread, so an idle connection costs no thread at all.
+"""
+import asyncio
+import threading
+import time
+
+from storage import RoomStoreWrapper
+
+
+class _Channel:
+    """Wake-up point for everyone waiting on one room."""
+    __slots__ = ('condition', 'seq', 'listeners', 'callbacks')
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.listeners = 0
+        self.callbacks = set()
+
+
+class RoomListener:
+    """Waits for writes to one room. Create it with RoomEvents.listen().
+
+    A listener remembers the last write it has seen, so a write that lands
+    between reading the room and calling wait() is not missed.
+    """
+
+    def __init__(self, events, room_key, channel):
+        self._events = events
+        self._room_key = room_key
+        self._channel = channel
+        self._seen = channel.seq
+
+    def wait(self, timeout):
+        """Block until the room is written or timeout seconds pass.
+
+        Returns:
+            bool: True if the room was written since the last call
+        """
+        deadline = time.monotonic() + timeout
+        with self._channel.condition:
+            while self._channel.seq == self._seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._channel.condition.wait(remaining)
+            self._seen = self._channel.seq
+            return True
+
+    def close(self):
+        self._events._release(self._room_key, self._channel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncRoomListener:
+    """Asyncio version of RoomListener. Create it with RoomEvents.listen_async()."""
+
+    def __init__(self, events, room_key, channel, loop):
+        self._events = events
+        self._room_key = room_key
+        self._channel = channel
+        self._loop = loop
+        self._changed = asyncio.Event()
+        with channel.condition:
+            channel.callbacks.add(self._wake)
+
+    def _wake(self):
+        # Called from whichever thread did the write
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait(self, timeout):
+        """Wait until the room is written or timeout seconds pass.
+
+        Returns:
+            bool: True if the room was written since the last call
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._changed.clear()
+        return True
+
+    def close(self):
+        with self._channel.condition:
+            self._channel.callbacks.discard(self._wake)
+        self._events._release(self._room_key, self._channel)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class RoomEvents:
+    """Per-room wake-ups for requests waiting on a room to change."""
+
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def listen(self, room_key):
+        """Start listening for writes to room_key.
+
+        Use the result as a context manager, and read the room after
+        entering it so no write can slip in unnoticed.
+        """
+        return RoomListener(self, room_key, self._acquire(room_key))
+
+    def listen_async(self, room_key):
+        """Like listen(), for code running on an asyncio event loop.
+
+        Use the result as an async context manager.
+        """
+        channel = self._acquire(room_key)
+        return AsyncRoomListener(self, room_key, channel, asyncio.get_running_loop())
+
+    def publish(self, room_key):
+        """Wake everyone listening on room_key."""
+        with self._lock:
+            channel = self._channels.get(room_key)
+        if channel is None:
+            return
+        with channel.condition:
+            channel.seq += 1
+            channel.condition.notify_all()
+            callbacks = list(channel.callbacks)
+        for callback in callbacks:
+            callback()
+
+    def _acquire(self, room_key):
+        with self._lock:
+            channel = self._channels.get(room_key)
+            if channel is None:
+                channel = self._channels[room_key] = _Channel()
+            channel.listeners += 1
+        return channel
+
+    def _release(self, room_key, channel):
+        with self._lock:
+            channel.listeners -= 1
+            if channel.listeners == 0 and self._channels.get(room_key) is channel:
+                del self._channels[room_key]
+
+
+class NotifyingRoomStore(RoomStoreWrapper):
+    """RoomStore wrapper that publishes a RoomEvents wake-up after every write.
+
+    It must be the outermost store, so that anyone woken up reads the room
+    after every layer underneath (including the cache) has the new state.
+    """
+
+    def __init__(self, backend, events):
+        super().__init__(backend)
+        self.events = events
+
+    def create(self, room_key, room_data):
+        self.backend.create(room_key, room_data)
+        self.events.publish(room_key)
+
+    def set(self, room_key, room_data):
+        self.backend.set(room_key, room_data)
+        self.events.publish(room_key)
+
+    def update(self, room_key, updates, expected_version=None):
+        self.backend.update(room_key, updates, expected_version=expected_version)
+        self.events.publish(room_key)
@@ -0,0 +1,130 @@
+"""Collision-free room key allocation.
+
+Room keys are short random strings, so with enough live rooms two new rooms
+will eventually draw the same key. RoomKeyAllocator never overwrites a room:
+every new room is written with the store's create(), which fails if the key
+is taken, and the allocator then simply tries another key.
+
+To avoid most of those failed round trips, the allocator remembers every
+key it has created or seen taken in a fixed-size Bloom filter and skips
+them locally. A false positive only throws away a free candidate, and a
+key the filter has never seen is still checked by create(), so memory
+stays constant however many rooms there are. Candidate keys are
+generated ahead of time into a pool, refilled in bulk on a background
+thread, so a burst of new rooms never waits on key generation.
+"""
+import hashlib
+import threading
+from collections import deque
+
+from storage import RoomExists
+
+# Candidate keys kept ready, and the level at which a refill starts
+DEFAULT_POOL_SIZE = 256
+REFILL_BELOW = 0.25
+# Keys tried for one room before giving up
+MAX_ATTEMPTS = 10
+# Size of the filter of taken keys: 1 MiB holds a million keys with about
+# 2% false positives
+DEFAULT_FILTER_BITS = 1 << 23
+FILTER_HASHES = 6
+
+
+class BloomFilter:
+    """Fixed-size set of strings that may report false positives, never false negatives."""
+
+    def __init__(self, bits=DEFAULT_FILTER_BITS, hashes=FILTER_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RoomKeyAllocator:
+    """Hands out unused room keys and creates the rooms under them.
+
+    Args:
+        store: RoomStore with create()
+        generate_key: Function returning a new random key
+        pool_size: Number of candidate keys generated in advance
+        filter_bits: Size of the filter of taken keys
+    """
+
+    def __init__(self, store, generate_key, pool_size=DEFAULT_POOL_SIZE, filter_bits=DEFAULT_FILTER_BITS):
+        self.store = store
+        self.generate_key = generate_key
+        self.pool_size = pool_size
+        # Keys known (or, rarely, wrongly believed) to be in use
+        self._taken = BloomFilter(filter_bits)
+        self._pool = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+
+    def allocate(self, room_data):
+        """Store room_data under a new, unused key.
+
+        Returns:
+            str: The room key
+
+        Raises:
+            RuntimeError: If MAX_ATTEMPTS keys in a row were taken
+        """
+        for _ in range(MAX_ATTEMPTS):
+            room_key = self._next_candidate()
+            try:
+                self.store.create(room_key, room_data)
+            except RoomExists:
+                # Created by another process; remember it and try again
+                self.mark_taken(room_key)
+                continue
+            self.mark_taken(room_key)
+            return room_key
+        raise RuntimeError(f'Could not find a free room key in {MAX_ATTEMPTS} attempts')
+
+    def mark_taken(self, room_key):
+        """Record that room_key is in use, e.g. after seeing the room in the store."""
+        with self._lock:
+            self._taken.add(room_key)
+
+    def prefill(self):
+        """Fill the candidate pool now, e.g. at startup."""
+        self._refill()
+
+    def _next_candidate(self):
+        with self._lock:
+            while self._pool:
+                room_key = self._pool.popleft()
+                if room_key not in self._taken:
+                    break
+            else:
+                room_key = None
+            start_refill = not self._refilling and len(self._pool) < self.pool_size * REFILL_BELOW
+            if start_refill:
+                self._refilling = True
+        if start_refill:
+            threading.Thread(target=self._refill, name='room-key-refill', daemon=True).start()
+        # Only when a burst emptied the pool before the refill caught up
+        return room_key if room_key is not None else self.generate_key()
+
+    def _refill(self):
+        try:
+            with self._lock:
+                missing = self.pool_size - len(self._pool)
+            keys = [self.generate_key() for _ in range(max(0, missing))]
+            with self._lock:
+                self._pool.extend(key for key in keys if key not in self._taken)
+        finally:
+            with self._lock:
+                self._refilling = False
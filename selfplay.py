@@ -0,0 +1,187 @@
+"""Self-play farm: runs engine.py games on every core.
+
+    python selfplay.py --games 100000 --seed 42
+    python selfplay.py --games 100000 --seed 42 --workers 1   # same numbers
+
+Game i is played with its own random.Random seeded from the master seed and
+i, so every game is the same no matter which worker runs it. Games are
+handed out in fixed-size chunks and the statistics are plain counts, so the
+merged results are identical for any number of workers.
+
+Like simulate.py, this scores a player by the total value of the animals on
+their field, since the server doesn't award points yet. simulate.py is the
+faster, approximate NumPy version; this one runs the exact rules in engine.py.
+"""
+import argparse
+import os
+import random
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+from cards import CARD_TABLE
+from engine import (DISCARD, DRAW, HAND_LIMIT, PLAY, PLAYER_DISCARD, WINNING_SCORE, Action,
+                    legal_actions, new_game, step)
+
+# Games per task sent to a worker
+CHUNK_SIZE = 500
+# Games still running after this many turns count as draws
+MAX_TURNS = 200
+
+POLICIES = ('greedy', 'random')
+
+
+def game_rng(master_seed, game_index):
+    """Return the random generator for one game.
+
+    String seeds are hashed the same way on every platform and Python
+    process, unlike hash() of a tuple.
+    """
+    return random.Random(f'{master_seed}:{game_index}')
+
+
+def field_score(state, player_idx):
+    """Total value of the animals on a player's field."""
+    return sum(CARD_TABLE[card].value or 0 for card in state.fields[player_idx])
+
+
+def choose_action(state, policy, rng):
+    """Pick the current player's next action.
+
+    Args:
+        state: The engine GameState
+        policy: 'greedy' plays the highest-value card (drawing when the hand
+            is empty) and discards the lowest-value cards. 'random' picks
+            uniformly among the legal actions.
+        rng: The game's random generator
+
+    Returns:
+        Action: The action to take
+    """
+    if policy == 'random':
+        return rng.choice(legal_actions(state))
+
+    hand = state.hands[state.current_turn - 1]
+    by_value = sorted(range(len(hand)), key=lambda i: CARD_TABLE[hand[i]].value or 0)
+    if state.phase == PLAYER_DISCARD:
+        return Action(DISCARD, card_indices=tuple(by_value[:len(hand) - HAND_LIMIT]))
+    if hand:
+        return Action(PLAY, by_value[-1])
+    return Action(DRAW)
+
+
+def play_game(master_seed, game_index, policy='greedy', max_turns=MAX_TURNS):
+    """Play one game to the end.
+
+    Returns:
+        tuple: (winner, turns, played) where winner is the player number
+               (1 or 2) or None for a draw, and played lists the card ids
+               played to the field
+    """
+    rng = game_rng(master_seed, game_index)
+    state = new_game(rng)
+    played = []
+    for turn in range(1, max_turns + 1):
+        player = state.current_turn
+        outcome = step(state, choose_action(state, policy, rng), rng)
+        if outcome.played is not None:
+            played.append(outcome.played)
+            if field_score(state, player - 1) >= WINNING_SCORE:
+                return player, turn, played
+        elif not state.deck and not state.discard_pile and not any(state.hands):
+            # Nobody can play or draw any more
+            return None, turn, played
+    return None, max_turns, played
+
+
+def run_chunk(task):
+    """Play games [start, stop) and return their statistics. Runs in a worker."""
+    master_seed, start, stop, policy, max_turns = task
+    stats = {'wins': Counter(), 'lengths': Counter(), 'plays': Counter()}
+    for game_index in range(start, stop):
+        winner, turns, played = play_game(master_seed, game_index, policy, max_turns)
+        stats['wins'][winner or 0] += 1
+        stats['lengths'][turns] += 1
+        stats['plays'].update(CARD_TABLE[card].name for card in played)
+    return stats
+
+
+def run_farm(games, seed=0, workers=None, policy='greedy', max_turns=MAX_TURNS, chunk_size=CHUNK_SIZE):
+    """Play games across a process pool and merge the statistics.
+
+    Args:
+        games: Number of games to play
+        seed: Master seed. The results depend only on it, games, policy
+              and max_turns.
+        workers: Number of processes. Defaults to the CPU count; 1 runs
+                 everything in this process.
+        policy: 'greedy' or 'random', see choose_action()
+        max_turns: Turn limit after which a game counts as a draw
+        chunk_size: Games per task
+
+    Returns:
+        dict: Win counts, game-length histogram, per-card play counts and
+              throughput
+    """
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown policy: {policy}')
+    workers = workers or os.cpu_count() or 1
+    tasks = [
+        (seed, start, min(start + chunk_size, games), policy, max_turns)
+        for start in range(0, games, chunk_size)
+    ]
+
+    merged = {'wins': Counter(), 'lengths': Counter(), 'plays': Counter()}
+    started = time.perf_counter()
+    if workers == 1:
+        for stats in map(run_chunk, tasks):
+            _merge(merged, stats)
+    else:
+        with Pool(workers) as pool:
+            for stats in pool.imap(run_chunk, tasks):
+                _merge(merged, stats)
+    elapsed = time.perf_counter() - started
+
+    wins = merged['wins']
+    lengths = merged['lengths']
+    return {
+        'games': games,
+        'seed': seed,
+        'policy': policy,
+        'workers': workers,
+        'wins': {'player_1': wins[1], 'player_2': wins[2], 'draw': wins[0]},
+        'mean_length': sum(turns * count for turns, count in lengths.items()) / games if games else 0,
+        'length_histogram': dict(sorted(lengths.items())),
+        'plays': dict(sorted(merged['plays'].items())),
+        'elapsed': elapsed,
+        'games_per_second': games / elapsed if elapsed else 0,
+    }
+
+
+def _merge(merged, stats):
+    for name, counts in stats.items():
+        merged[name].update(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play self-play games on every core.')
+    parser.add_argument('--games', type=int, default=10000, help='number of games to play')
+    parser.add_argument('--seed', type=int, default=0, help='master seed')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--policy', choices=POLICIES, default='greedy', help='how the bots choose moves')
+    parser.add_argument('--max-turns', type=int, default=MAX_TURNS, help='turn limit per game')
+    args = parser.parse_args(argv)
+
+    result = run_farm(args.games, args.seed, args.workers, args.policy, args.max_turns)
+    wins = result['wins']
+    games = result['games'] or 1
+    print(f"{result['games']} games, seed {result['seed']}, {result['policy']} policy, "
+          f"{result['workers']} worker(s)")
+    print(f"Wins: player 1 {wins['player_1'] / games:.1%}, player 2 {wins['player_2'] / games:.1%}, "
+          f"draw {wins['draw'] / games:.1%}")
+    print(f"Mean game length: {result['mean_length']:.2f} turns")
+    print(f"Throughput: {result['games_per_second']:,.0f} games/s ({result['elapsed']:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Monte Carlo deck-balance simulator.
+
+Plays many games at once with every deck, hand and score held in NumPy
+arrays, so trying a change to DECK_COMPOSITION takes seconds:
+
+    python simulate.py --games 100000
+    python simulate.py --games 100000 --set shark=2 --set fast_tuna=2
+
+It follows the turn rules in engine.py for the moves the bots make: play a
+card from hand to field, or draw 2 cards and put anything over 4 back on the
+bottom of the deck. The server doesn't award points yet, so a player's score
+here is the total value of the animals on their field, and the first to
+reach engine.WINNING_SCORE wins.
+
+Requires NumPy (pip install numpy).
+"""
+import argparse
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cards import DECK_COMPOSITION, build_catalog
+from engine import CARDS_PER_DRAW, HAND_LIMIT, INITIAL_HAND, WINNING_SCORE
+
+# Room for the largest hand a bot can hold (the opening hand plus 2 just drawn)
+MAX_HAND = max(INITIAL_HAND, HAND_LIMIT) + CARDS_PER_DRAW
+# Games still running after this many turns count as draws
+MAX_TURNS = 200
+# How often the random policy draws instead of playing
+DRAW_PROBABILITY = 0.25
+
+POLICIES = ('greedy', 'random')
+
+
+def simulate(composition=None, games=10000, policy='greedy', seed=None, max_turns=MAX_TURNS):
+    """Play a batch of games and collect balance statistics.
+
+    Args:
+        composition: card_name: quantity mapping. Defaults to DECK_COMPOSITION.
+        games: Number of games to play
+        policy: 'greedy' plays the highest-value card in hand and draws when
+            the hand is empty. 'random' plays a random card, and draws with
+            probability DRAW_PROBABILITY or when the hand is empty.
+        seed: Seed for the random generator
+        max_turns: Turn limit after which a game counts as a draw
+
+    Returns:
+        dict: win rates, game lengths and per-card play counts
+    """
+    if np is None:
+        raise RuntimeError('simulate.py requires NumPy: pip install numpy')
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown policy: {policy}')
+
+    catalog = build_catalog(composition)
+    deck_size = len(catalog)
+    if deck_size < 2 * INITIAL_HAND:
+        raise ValueError('The deck is too small to deal both opening hands')
+    rng = np.random.default_rng(seed)
+
+    # Card values, with an extra -1 slot at the end so that indexing with
+    # the empty-slot marker (-1) yields a value below every real card
+    values = np.array([card.value or 0 for card in catalog] + [-1], dtype=np.int64)
+
+    # Each deck is a ring buffer of card ids: draws come off the top and
+    # cards put back go under the bottom
+    decks = rng.permuted(np.tile(np.arange(deck_size), (games, 1)), axis=1)
+    top = np.full(games, deck_size)  # One past the top card
+    bottom = np.zeros(games, dtype=np.int64)
+    in_deck = np.full(games, deck_size)
+
+    hands = np.full((games, 2, MAX_HAND), -1, dtype=np.int64)
+    hand_sizes = np.zeros((games, 2), dtype=np.int64)
+    scores = np.zeros((games, 2), dtype=np.int64)
+    current = np.zeros(games, dtype=np.int64)  # Player index, 0 or 1
+    winners = np.full(games, -1)
+    lengths = np.full(games, max_turns)
+    active = np.ones(games, dtype=bool)
+    plays = np.zeros(deck_size, dtype=np.int64)
+
+    # Deal opening hands, alternating between the players
+    for i in range(INITIAL_HAND):
+        for player in (0, 1):
+            top -= 1
+            hands[:, player, i] = decks[:, top[0] % deck_size]
+            hand_sizes[:, player] += 1
+    in_deck -= 2 * INITIAL_HAND
+
+    for turn in range(max_turns):
+        g = np.nonzero(active)[0]
+        if len(g) == 0:
+            break
+        p = current[g]
+        hand = hands[g, p]
+        size = hand_sizes[g, p]
+
+        if policy == 'greedy':
+            play = size > 0
+            # Highest value first, earliest slot on ties
+            slot = np.argmax(values[hand], axis=1)
+        else:
+            play = (size > 0) & ((rng.random(len(g)) >= DRAW_PROBABILITY) | (in_deck[g] == 0))
+            # Random card among the filled slots
+            slot = np.argmax(np.where(hand >= 0, rng.random(hand.shape), -1.0), axis=1)
+
+        # Play: move the chosen card to the field, filling its slot with the last card
+        pg, pp, ps = g[play], p[play], slot[play]
+        card = hands[pg, pp, ps]
+        last = hand_sizes[pg, pp] - 1
+        hands[pg, pp, ps] = hands[pg, pp, last]
+        hands[pg, pp, last] = -1
+        hand_sizes[pg, pp] -= 1
+        scores[pg, pp] += values[card]
+        np.add.at(plays, card, 1)
+
+        # Draw: up to 2 cards off the top, then the newest excess to the bottom
+        dg, dp = g[~play], p[~play]
+        for _ in range(CARDS_PER_DRAW):
+            has = in_deck[dg] > 0
+            hg, hp = dg[has], dp[has]
+            top[hg] -= 1
+            in_deck[hg] -= 1
+            hands[hg, hp, hand_sizes[hg, hp]] = decks[hg, top[hg] % deck_size]
+            hand_sizes[hg, hp] += 1
+        for _ in range(MAX_HAND - HAND_LIMIT):
+            over = hand_sizes[dg, dp] > HAND_LIMIT
+            og, op = dg[over], dp[over]
+            last = hand_sizes[og, op] - 1
+            bottom[og] -= 1
+            in_deck[og] += 1
+            decks[og, bottom[og] % deck_size] = hands[og, op, last]
+            hands[og, op, last] = -1
+            hand_sizes[og, op] -= 1
+
+        # Finish games that were won, or where neither player can move
+        won = scores[g, p] >= WINNING_SCORE
+        stuck = (in_deck[g] == 0) & (hand_sizes[g].sum(axis=1) == 0)
+        done = g[won | stuck]
+        winners[g[won]] = p[won]
+        lengths[done] = turn + 1
+        active[done] = False
+        current[g] = 1 - p
+
+    names = sorted({card.name for card in catalog})
+    play_counts = dict.fromkeys(names, 0)
+    for card_id, count in enumerate(plays):
+        play_counts[catalog[card_id].name] += int(count)
+    copies = dict.fromkeys(names, 0)
+    for card in catalog:
+        copies[card.name] += 1
+
+    return {
+        'games': games,
+        'policy': policy,
+        'win_rate': {
+            'player_1': float(np.mean(winners == 0)),
+            'player_2': float(np.mean(winners == 1)),
+            'draw': float(np.mean(winners == -1)),
+        },
+        'game_length': {
+            'mean': float(np.mean(lengths)),
+            'p50': float(np.percentile(lengths, 50)),
+            'p90': float(np.percentile(lengths, 90)),
+            'max': int(np.max(lengths)),
+        },
+        # Average plays per game for each card name, and per copy in the deck
+        'plays_per_game': {name: play_counts[name] / games for name in names},
+        'plays_per_copy': {name: play_counts[name] / games / copies[name] for name in names},
+    }
+
+
+def print_report(stats):
+    """Print simulate() results as a readable table."""
+    win_rate = stats['win_rate']
+    length = stats['game_length']
+    print(f"{stats['games']} games, {stats['policy']} policy")
+    print(f"Win rate: player 1 {win_rate['player_1']:.1%}, player 2 {win_rate['player_2']:.1%}, "
+          f"draw {win_rate['draw']:.1%}")
+    print(f"Game length (turns): mean {length['mean']:.1f}, p50 {length['p50']:.0f}, "
+          f"p90 {length['p90']:.0f}, max {length['max']}")
+    print(f"\n{'card':<20}{'plays/game':>12}{'plays/copy':>12}")
+    for name, per_game in sorted(stats['plays_per_game'].items(), key=lambda item: -item[1]):
+        print(f"{name:<20}{per_game:>12.3f}{stats['plays_per_copy'][name]:>12.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate games to check deck balance.')
+    parser.add_argument('--games', type=int, default=10000, help='number of games to play')
+    parser.add_argument('--policy', choices=POLICIES, default='greedy', help='how the bots choose moves')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--max-turns', type=int, default=MAX_TURNS, help='turn limit per game')
+    parser.add_argument('--set', action='append', default=[], metavar='CARD=QTY',
+                        help='override the quantity of a card in DECK_COMPOSITION')
+    args = parser.parse_args(argv)
+
+    composition = dict(DECK_COMPOSITION)
+    for override in args.set:
+        name, _, quantity = override.partition('=')
+        if name not in composition:
+            parser.error(f'Unknown card: {name}')
+        composition[name] = int(quantity)
+
+    if np is None:
+        sys.exit('simulate.py requires NumPy: pip install numpy')
+    start = time.perf_counter()
+    stats = simulate(composition, args.games, args.policy, args.seed, args.max_turns)
+    elapsed = time.perf_counter() - start
+    print_report(stats)
+    print(f'\nSimulated in {elapsed:.2f}s ({args.games / elapsed:,.0f} games/s)')
+
+
+if __name__ == '__main__':
+    main()
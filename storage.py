@@ -0,0 +1,550 @@
+"""Room storage backends for the game server.
+
+Every room is a single document keyed by its room key. The routes in game.py
+only talk to a RoomStore, so the same server can run against Firestore in
+production or against an in-process store for tests, benchmarks and
+single-node deployments.
+
+Select the backend with the ROOM_STORE environment variable:
+    firestore  - Google Cloud Firestore (default)
+    memory     - plain dict, lost when the process exits
+    sqlite     - dict kept in memory and persisted to ROOM_STORE_PATH
+"""
+import copy
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Service account used by the Firestore backend
+FIREBASE_CREDENTIALS = 'vegan-cardgame-firebase-adminsdk-fbsvc-b2013bb175.json'
+
+# How many times apply_move re-reads and retries a move after a conflict
+MAX_MOVE_ATTEMPTS = 5
+
+# Rooms FirestoreRoomStore keeps write bookkeeping for. Rooms beyond that
+# fall back to the slower paths (transactions, whole players writes), which
+# are always correct.
+TRACKED_ROOMS = 10000
+
+
+# Marks a field that did not exist before a change
+_MISSING = object()
+
+
+class VersionConflict(Exception):
+    """Raised when a room changed since the version a write was based on."""
+
+
+class RoomExists(Exception):
+    """Raised by create() when a room with that key is already stored."""
+
+
+class RoomStore:
+    """Interface shared by all room storage backends.
+
+    Room data is exchanged as plain dicts. Callers own the dicts they get
+    back and may modify them freely; nothing is written until set() or
+    update() is called. Every room carries an integer 'version' field that
+    goes up by one on each write, so a write can be made conditional on the
+    room not having changed since it was read.
+
+    update() takes a dict of changes keyed by field path. A path is either a
+    top-level field name or a tuple of keys and list indices leading to a
+    nested value, e.g. ('players', 0, 'hand').
+    """
+
+    def get(self, room_key):
+        """Return the room data for room_key, or None if it does not exist."""
+        raise NotImplementedError
+
+    def snapshot(self, room_key):
+        """Return the room data for room_key for reading only, or None.
+
+        Unlike get(), the result may be shared with other callers and must
+        not be modified. Stores that keep rooms in memory return them
+        without making a copy.
+        """
+        return self.get(room_key)
+
+    def create(self, room_key, room_data):
+        """Store a new room, but only if room_key is not taken.
+
+        A room_data without a 'version' is stored as version 1.
+
+        Raises:
+            RoomExists: If a room is already stored under room_key
+        """
+        raise NotImplementedError
+
+    def set(self, room_key, room_data):
+        """Create or overwrite the room stored under room_key.
+
+        A room_data without a 'version' is stored as version 1.
+        """
+        raise NotImplementedError
+
+    def update(self, room_key, updates, expected_version=None):
+        """Overwrite the given fields of an existing room.
+
+        Args:
+            room_key: Key of the room to update
+            updates: Dict mapping field paths to their new values
+            expected_version: If given, the write only happens when the stored
+                room still has this version, otherwise VersionConflict is raised
+
+        If updates has no 'version', the stored version is incremented.
+        """
+        raise NotImplementedError
+
+    def diff(self, room_key, room_data, updates):
+        """Return the smallest set of path changes that applies updates to room_data.
+
+        Backends override this when they can only address part of the
+        document, e.g. Firestore cannot write a single list element.
+        """
+        return diff_fields(room_data, updates)
+
+
+class RoomStoreWrapper(RoomStore):
+    """RoomStore that passes every call on to another store.
+
+    Layers such as the cache, change notifications and metrics subclass it
+    and override only the calls they change. Attributes outside the
+    RoomStore interface (e.g. the cache's invalidate()) come from the
+    wrapped store as well.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, room_key, **kwargs):
+        return self.backend.get(room_key, **kwargs)
+
+    def snapshot(self, room_key):
+        return self.backend.snapshot(room_key)
+
+    def create(self, room_key, room_data):
+        self.backend.create(room_key, room_data)
+
+    def set(self, room_key, room_data):
+        self.backend.set(room_key, room_data)
+
+    def update(self, room_key, updates, expected_version=None):
+        self.backend.update(room_key, updates, expected_version=expected_version)
+
+    def diff(self, room_key, room_data, updates):
+        return self.backend.diff(room_key, room_data, updates)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class _RecentRooms:
+    """A value per room for the most recently written rooms only. Thread-safe."""
+
+    def __init__(self, max_rooms):
+        self.max_rooms = max_rooms
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, room_key, default=None):
+        with self._lock:
+            return self._values.get(room_key, default)
+
+    def put(self, room_key, value=True):
+        with self._lock:
+            self._values[room_key] = value
+            self._values.move_to_end(room_key)
+            while len(self._values) > self.max_rooms:
+                self._values.popitem(last=False)
+
+    def discard(self, room_key):
+        with self._lock:
+            self._values.pop(room_key, None)
+
+    def __contains__(self, room_key):
+        with self._lock:
+            return room_key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+
+class FirestoreRoomStore(RoomStore):
+    """Rooms stored as documents in a Firestore collection.
+
+    Firestore can't update a single element of an array, so the players list
+    is stored as a map keyed by player index ('0', '1'). That lets a move
+    write just players.0.hand instead of both players. Rooms written before
+    this layout keep their players array until their next full players write.
+    """
+
+    def __init__(self, client=None, collection='rooms'):
+        # The client is created on first use, so building the store doesn't
+        # import the Firebase SDK or read the credentials file
+        self._client_instance = client
+        self._collection_name = collection
+        self._collection_ref = None
+        self._connect_lock = threading.Lock()
+        # (version, update_time) of the last snapshot seen for each room, so a
+        # conditional write can use an update-time precondition instead of
+        # reading the document again inside a transaction
+        self._update_times = _RecentRooms(TRACKED_ROOMS)
+        # Rooms known to store players as a map
+        self._players_as_map = _RecentRooms(TRACKED_ROOMS)
+
+    @property
+    def _client(self):
+        if self._collection_ref is None:
+            self._connect()
+        return self._client_instance
+
+    @property
+    def _collection(self):
+        if self._collection_ref is None:
+            self._connect()
+        return self._collection_ref
+
+    def _connect(self):
+        with self._connect_lock:
+            if self._collection_ref is None:
+                if self._client_instance is None:
+                    self._client_instance = _firestore_client()
+                self._collection_ref = self._client_instance.collection(self._collection_name)
+
+    def warm_up(self):
+        """Create the client and open its connection before the first request needs it."""
+        # Reading a missing document sets up the channel and the auth token
+        self._collection.document('_warm_up').get()
+
+    def get(self, room_key):
+        snapshot = self._collection.document(room_key).get()
+        if not snapshot.exists:
+            self._update_times.discard(room_key)
+            return None
+        room_data = snapshot.to_dict()
+        self._update_times.put(room_key, (room_data.get('version', 0), snapshot.update_time))
+        players = room_data.get('players')
+        if isinstance(players, dict):
+            self._players_as_map.put(room_key)
+            room_data['players'] = [players[i] for i in sorted(players, key=int)]
+        else:
+            self._players_as_map.discard(room_key)
+        return room_data
+
+    def create(self, room_key, room_data):
+        from google.api_core.exceptions import Conflict
+
+        room_data = dict(room_data)
+        room_data.setdefault('version', 1)
+        if isinstance(room_data.get('players'), list):
+            room_data['players'] = _players_map(room_data['players'])
+        try:
+            # create() fails on the server if the document exists
+            result = self._collection.document(room_key).create(room_data)
+        except Conflict:
+            raise RoomExists(room_key)
+        self._update_times.put(room_key, (room_data.get('version', 0), result.update_time))
+        self._players_as_map.put(room_key)
+
+    def set(self, room_key, room_data):
+        room_data = dict(room_data)
+        room_data.setdefault('version', 1)
+        if isinstance(room_data.get('players'), list):
+            room_data['players'] = _players_map(room_data['players'])
+        result = self._collection.document(room_key).set(room_data)
+        self._update_times.put(room_key, (room_data.get('version', 0), result.update_time))
+        self._players_as_map.put(room_key)
+
+    def diff(self, room_key, room_data, updates):
+        changes = diff_fields(room_data, updates)
+        new_data = dict(room_data, **updates)
+        by_player = room_key in self._players_as_map
+        coalesced = {}
+        for path, value in changes.items():
+            path = _as_path(path)
+            # Cut the path at the first list index Firestore can't address.
+            # Every path under a cut point is cut at the same place, so the
+            # shortened paths never overlap each other.
+            for depth, key in enumerate(path):
+                if isinstance(key, int) and not (by_player and depth == 1 and path[0] == 'players'):
+                    path = path[:depth]
+                    value = _get_path(new_data, path)
+                    break
+            coalesced[path if len(path) > 1 else path[0]] = value
+        return coalesced
+
+    def update(self, room_key, updates, expected_version=None):
+        doc_ref = self._collection.document(room_key)
+        rewrites_players = 'players' in updates or ('players',) in updates
+        fields = self._field_updates(updates)
+        if 'version' not in fields:
+            from firebase_admin import firestore
+
+            fields['version'] = firestore.Increment(1)
+        if 'version' in updates:
+            new_version = updates['version']
+        else:
+            new_version = expected_version + 1 if expected_version is not None else None
+
+        known = self._update_times.get(room_key)
+        if expected_version is None:
+            doc_ref.update(fields)
+            self._update_times.discard(room_key)
+        elif known is not None and known[0] == expected_version:
+            # One round trip: the write fails if anyone wrote since our read
+            from google.api_core.exceptions import FailedPrecondition
+
+            option = self._client.write_option(last_update_time=known[1])
+            try:
+                result = doc_ref.update(fields, option=option)
+            except FailedPrecondition:
+                self._update_times.discard(room_key)
+                raise VersionConflict(room_key)
+            self._update_times.put(room_key, (new_version, result.update_time))
+        else:
+            self._update_in_transaction(doc_ref, fields, expected_version)
+            # Transactions don't hand back the write time, so the next
+            # conditional write uses a transaction too unless a read refreshes it
+            self._update_times.discard(room_key)
+
+        if rewrites_players:
+            self._players_as_map.put(room_key)
+
+    def _field_updates(self, updates):
+        """Translate field paths into Firestore update keys and the stored players layout."""
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        fields = {}
+        for path, value in updates.items():
+            path = _as_path(path)
+            if path == ('players',) and isinstance(value, list):
+                value = _players_map(value)
+            fields[FieldPath(*(str(key) for key in path)).to_api_repr()] = value
+        return fields
+
+    def _update_in_transaction(self, doc_ref, updates, expected_version):
+        """Check the stored version and write inside a Firestore transaction."""
+        from firebase_admin import firestore
+
+        @firestore.transactional
+        def check_and_update(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise KeyError(f'Room {doc_ref.id} does not exist')
+            if snapshot.to_dict().get('version', 0) != expected_version:
+                raise VersionConflict(doc_ref.id)
+            transaction.update(doc_ref, updates)
+
+        check_and_update(self._client.transaction())
+
+
+class MemoryRoomStore(RoomStore):
+    """Rooms kept in a dict in this process.
+
+    If a path is given, every write is also persisted to a SQLite database
+    and existing rooms are loaded from it on startup, so a single-node
+    server survives restarts. Reads never touch the database.
+    """
+
+    def __init__(self, path=None):
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS rooms (room_key TEXT PRIMARY KEY, data TEXT NOT NULL)'
+            )
+            self._db.commit()
+            for room_key, data in self._db.execute('SELECT room_key, data FROM rooms'):
+                self._rooms[room_key] = json.loads(data)
+
+    def get(self, room_key):
+        with self._lock:
+            room_data = self._rooms.get(room_key)
+            return copy.deepcopy(room_data) if room_data is not None else None
+
+    def create(self, room_key, room_data):
+        with self._lock:
+            if room_key in self._rooms:
+                raise RoomExists(room_key)
+            self._rooms[room_key] = copy.deepcopy(room_data)
+            self._rooms[room_key].setdefault('version', 1)
+            self._persist(room_key)
+
+    def set(self, room_key, room_data):
+        with self._lock:
+            self._rooms[room_key] = copy.deepcopy(room_data)
+            self._rooms[room_key].setdefault('version', 1)
+            self._persist(room_key)
+
+    def update(self, room_key, updates, expected_version=None):
+        with self._lock:
+            if room_key not in self._rooms:
+                raise KeyError(f'Room {room_key} does not exist')
+            if expected_version is not None and self._rooms[room_key].get('version', 0) != expected_version:
+                raise VersionConflict(room_key)
+            room_data = self._rooms[room_key]
+            for path, value in updates.items():
+                set_path(room_data, path, copy.deepcopy(value))
+            if 'version' not in updates:
+                room_data['version'] = room_data.get('version', 0) + 1
+            self._persist(room_key)
+
+    def _persist(self, room_key):
+        """Write one room through to SQLite. Must be called with the lock held."""
+        if self._db is None:
+            return
+        self._db.execute(
+            'INSERT OR REPLACE INTO rooms (room_key, data) VALUES (?, ?)',
+            (room_key, json.dumps(self._rooms[room_key]))
+        )
+        self._db.commit()
+
+
+def apply_move(store, room_key, move, max_attempts=MAX_MOVE_ATTEMPTS):
+    """Apply a move to a room as one optimistic-concurrency write.
+
+    The room is read, move() works out the changes on that copy, and the
+    changes are written only if nobody else wrote the room in between. On a
+    conflict the room is read again and the move retried.
+
+    Args:
+        store: RoomStore holding the room
+        room_key: Key of the room to change
+        move: Function taking the room data and returning (updates, result).
+            updates is a dict of top-level fields to write, or None to write
+            nothing. It must not have side effects, as it may run more than once.
+        max_attempts: How many times to try before giving up
+
+    Returns:
+        tuple: (room_data, result) with room_data reflecting the write, or
+               (None, None) if the room does not exist
+
+    Raises:
+        VersionConflict: If every attempt lost a race with another write
+    """
+    for _ in range(max_attempts):
+        room_data = store.get(room_key)
+        if room_data is None:
+            return None, None
+
+        updates, result = move(room_data)
+        if not updates:
+            return room_data, result
+
+        version = room_data.get('version', 0)
+        updates = dict(updates, version=version + 1)
+        # Only write the parts of the room the move actually changed
+        changes = store.diff(room_key, room_data, updates)
+        try:
+            store.update(room_key, changes, expected_version=version)
+        except VersionConflict:
+            continue
+        room_data.update(updates)
+        return room_data, result
+    raise VersionConflict(room_key)
+
+
+def diff_fields(room_data, updates):
+    """Compare new top-level values against a room and return the changed paths.
+
+    Nested dicts and equal-length lists are compared element by element, so
+    moving one card out of a hand yields ('players', 0, 'hand') rather than
+    the whole players list. When more than half of a container's children
+    changed, the container is written whole instead.
+
+    Args:
+        room_data: The room as it is stored now
+        updates: Top-level fields with their new values
+
+    Returns:
+        dict: Changed field paths mapped to their new values. Top-level paths
+              are plain field names, nested ones are tuples.
+    """
+    changes = {}
+    for field, value in updates.items():
+        for path, new_value in _diff_value(room_data.get(field, _MISSING), value, (field,)).items():
+            changes[path if len(path) > 1 else path[0]] = new_value
+    return changes
+
+
+def _diff_value(old, new, path):
+    if old == new:
+        return {}
+    children = None
+    if isinstance(old, dict) and isinstance(new, dict) and old.keys() <= new.keys():
+        children = [(key, old.get(key, _MISSING), value) for key, value in new.items()]
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        children = list(zip(range(len(new)), old, new))
+
+    if children:
+        changes = {}
+        changed = 0
+        for key, old_child, new_child in children:
+            child_changes = _diff_value(old_child, new_child, path + (key,))
+            if child_changes:
+                changed += 1
+                changes.update(child_changes)
+        if changed * 2 <= len(children):
+            return changes
+    return {path: new}
+
+
+def set_path(data, path, value):
+    """Set the value at a field path inside nested dicts and lists."""
+    path = _as_path(path)
+    for key in path[:-1]:
+        if isinstance(data, dict):
+            data = data.setdefault(key, {})
+        else:
+            data = data[key]
+    data[path[-1]] = value
+
+
+def _get_path(data, path):
+    for key in path:
+        data = data[key]
+    return data
+
+
+def _as_path(path):
+    return path if isinstance(path, tuple) else (path,)
+
+
+def _players_map(players):
+    return {str(i): player for i, player in enumerate(players)}
+
+
+def _firestore_client():
+    """Initialize the Firebase Admin SDK and return a Firestore client."""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    cred = credentials.Certificate(FIREBASE_CREDENTIALS)
+    firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+def create_room_store(backend=None, path=None):
+    """Create the room store selected by the arguments or the environment.
+
+    Args:
+        backend: 'firestore', 'memory' or 'sqlite'. Defaults to $ROOM_STORE.
+        path: SQLite database file for the 'sqlite' backend. Defaults to
+            $ROOM_STORE_PATH, then rooms.sqlite3.
+
+    Returns:
+        RoomStore: The configured backend
+    """
+    backend = backend or os.environ.get('ROOM_STORE', 'firestore')
+    if backend == 'firestore':
+        return FirestoreRoomStore()
+    if backend == 'memory':
+        return MemoryRoomStore()
+    if backend == 'sqlite':
+        return MemoryRoomStore(path or os.environ.get('ROOM_STORE_PATH', 'rooms.sqlite3'))
+    raise ValueError(f'Unknown room store backend: {backend}')
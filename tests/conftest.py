@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Never reach for Firestore credentials from a test
+os.environ.setdefault('ROOM_STORE', 'memory')
+
+
+from storage import RoomStoreWrapper, VersionConflict  # noqa: E402
+
+
+class CountingStore(RoomStoreWrapper):
+    """Counts reads and version conflicts, and can hold the next read until released."""
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.gets = 0
+        self.conflicts = 0
+        self.error = None
+        self._hold = None
+        self.entered = threading.Event()
+
+    def hold_next_read(self):
+        self._hold = threading.Event()
+        self.entered.clear()
+        return self._hold
+
+    def get(self, room_key, **kwargs):
+        self.gets += 1
+        room_data = self.backend.get(room_key, **kwargs)
+        hold, self._hold = self._hold, None
+        if hold is not None:
+            self.entered.set()
+            hold.wait(5)
+        if self.error is not None:
+            raise self.error
+        return room_data
+
+    def update(self, room_key, updates, expected_version=None):
+        try:
+            self.backend.update(room_key, updates, expected_version=expected_version)
+        except VersionConflict:
+            self.conflicts += 1
+            raise
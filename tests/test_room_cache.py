@@ -0,0 +1,189 @@
+import threading
+import time
+
+import pytest
+
+from conftest import CountingStore
+from room_cache import CachedRoomStore, SingleFlight
+from storage import MemoryRoomStore
+
+
+def in_thread(func, *args, **kwargs):
+    """Start func on a thread and return a dict that gets its result or error."""
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+
+    outcome['thread'] = threading.Thread(target=run)
+    outcome['thread'].start()
+    return outcome
+
+
+def wait_for_followers():
+    # Followers have no observable state before the leader finishes, so give
+    # them time to join the read in flight
+    time.sleep(0.1)
+
+
+@pytest.fixture
+def stores():
+    backend = CountingStore(MemoryRoomStore())
+    backend.backend.set('R', {'n': 1})
+    return backend, CachedRoomStore(backend)
+
+
+def test_concurrent_misses_share_one_backend_read(stores):
+    backend, cache = stores
+    release = backend.hold_next_read()
+    readers = [in_thread(cache.get, 'R')]
+    assert backend.entered.wait(5)
+    readers += [in_thread(cache.get, 'R') for _ in range(4)]
+    wait_for_followers()
+    release.set()
+    for reader in readers:
+        reader['thread'].join(5)
+
+    assert backend.gets == 1
+    assert [reader['result'] for reader in readers] == [{'n': 1, 'version': 1}] * 5
+    # Every caller got its own copy
+    assert len({id(reader['result']) for reader in readers}) == 5
+
+
+def test_hit_does_not_read_backend(stores):
+    backend, cache = stores
+    cache.get('R')
+    cache.get('R')
+    assert backend.gets == 1
+
+
+def test_hit_older_than_max_age_rereads_backend():
+    now = [0.0]
+    backend = CountingStore(MemoryRoomStore())
+    backend.backend.set('R', {'n': 1})
+    cache = CachedRoomStore(backend, max_age=1.0, clock=lambda: now[0])
+    cache.get('R')
+    # Written by another process, which this cache never hears about
+    backend.backend.update('R', {'n': 2})
+
+    # Polling keeps the entry from going idle, but not from aging out
+    now[0] = 0.5
+    assert cache.get('R') == {'n': 1, 'version': 1}
+    now[0] = 1.5
+    assert cache.get('R') == {'n': 2, 'version': 2}
+    assert backend.gets == 2
+
+
+def test_snapshot_shares_the_cached_room(stores):
+    backend, cache = stores
+    snapshot = cache.snapshot('R')
+    assert cache.snapshot('R') is snapshot
+    assert cache.get('R') is not snapshot
+    assert backend.gets == 1
+
+    # A write replaces the entry, leaving earlier snapshots as they were
+    cache.update('R', {'n': 2}, expected_version=1)
+    assert snapshot == {'n': 1, 'version': 1}
+    assert cache.snapshot('R') == {'n': 2, 'version': 2}
+
+
+def test_min_version_refetches_an_older_entry(stores):
+    backend, cache = stores
+    assert cache.get('R')['version'] == 1
+    # Written behind the cache's back, e.g. by another process
+    backend.backend.update('R', {'n': 2})
+
+    assert cache.get('R')['version'] == 1
+    assert cache.get('R', min_version=2) == {'n': 2, 'version': 2}
+    assert backend.gets == 2
+    # The refetched version is cached
+    assert cache.get('R') == {'n': 2, 'version': 2}
+    assert backend.gets == 2
+
+
+def test_min_version_follower_rereads_after_joining_an_older_read(stores):
+    backend, cache = stores
+    release = backend.hold_next_read()
+    leader = in_thread(cache.get, 'R')
+    assert backend.entered.wait(5)
+    # The read in flight already has version 1; version 2 lands after it
+    backend.backend.update('R', {'n': 2})
+    follower = in_thread(cache.get, 'R', min_version=2)
+    wait_for_followers()
+    release.set()
+    leader['thread'].join(5)
+    follower['thread'].join(5)
+
+    assert leader['result']['version'] == 1
+    assert follower['result'] == {'n': 2, 'version': 2}
+    assert backend.gets == 2
+
+
+def test_read_in_flight_does_not_overwrite_a_newer_write(stores):
+    backend, cache = stores
+    release = backend.hold_next_read()
+    reader = in_thread(cache.get, 'R')
+    assert backend.entered.wait(5)
+    # A write through the cache finishes while the slow read still holds version 1
+    cache.update('R', {'n': 2}, expected_version=1)
+    release.set()
+    reader['thread'].join(5)
+
+    reads = backend.gets
+    assert reader['result'] == {'n': 2, 'version': 2}
+    assert cache.get('R') == {'n': 2, 'version': 2}
+    assert backend.gets == reads
+
+
+def test_unconditional_update_matches_the_store(stores):
+    backend, cache = stores
+    cache.get('R')
+    # Another writer moves the store past the cached copy
+    backend.backend.update('R', {'n': 2})
+    cache.update('R', {'m': 1})
+    assert cache.get('R') == backend.backend.get('R') == {'n': 2, 'm': 1, 'version': 3}
+
+
+def test_read_in_flight_is_not_cached_after_an_unconditional_update(stores):
+    backend, cache = stores
+    release = backend.hold_next_read()
+    reader = in_thread(cache.get, 'R')
+    assert backend.entered.wait(5)
+    cache.update('R', {'n': 2})
+    release.set()
+    reader['thread'].join(5)
+
+    # The slow read returns what it saw but doesn't keep it
+    assert reader['result'] == {'n': 1, 'version': 1}
+    assert cache.get('R') == {'n': 2, 'version': 2}
+
+
+def test_followers_see_the_leaders_exception(stores):
+    backend, cache = stores
+    backend.error = RuntimeError('backend down')
+    release = backend.hold_next_read()
+    readers = [in_thread(cache.get, 'R')]
+    assert backend.entered.wait(5)
+    readers += [in_thread(cache.get, 'R') for _ in range(3)]
+    wait_for_followers()
+    release.set()
+    for reader in readers:
+        reader['thread'].join(5)
+
+    assert backend.gets == 1
+    assert all(isinstance(reader.get('error'), RuntimeError) for reader in readers)
+
+    # Nothing was cached, and the next read tries the backend again
+    backend.error = None
+    assert cache.get('R') == {'n': 1, 'version': 1}
+    assert backend.gets == 2
+
+
+def test_single_flight_runs_again_after_the_call_finishes():
+    flights = SingleFlight()
+    calls = []
+    assert flights.do('k', lambda: calls.append(1) or len(calls)) == 1
+    assert flights.do('k', lambda: calls.append(1) or len(calls)) == 2
@@ -0,0 +1,204 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import CountingStore
+from room_shards import HashRing, ShardScheduler
+from storage import MemoryRoomStore
+
+NODES = ['http://game-1:5000', 'http://game-2:5000', 'http://game-3:5000']
+KEYS = [f'ROOM{i:04d}' for i in range(2000)]
+
+
+def increment(room_data):
+    return {'n': room_data['n'] + 1}, room_data['n'] + 1
+
+
+def run_together(count, func):
+    """Call func(i) on count threads released at the same moment."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        results[i] = func(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+@pytest.fixture
+def store():
+    store = CountingStore(MemoryRoomStore())
+    store.set('R', {'n': 0, 'owner': None})
+    return store
+
+
+def test_racing_moves_on_one_room_let_exactly_one_win(store):
+    shards = ShardScheduler(store, shards=4)
+
+    def claim(i):
+        def move(room_data):
+            if room_data['owner'] is not None:
+                return None, 'taken'
+            return {'owner': i}, 'won'
+        return shards.apply_move('R', move)[1]
+
+    results = run_together(10, claim)
+    assert sorted(results) == ['taken'] * 9 + ['won']
+    assert store.get('R')['owner'] == results.index('won')
+    # Serial moves never raced each other into a conflict
+    assert store.conflicts == 0
+
+
+def test_racing_moves_are_all_applied_in_turn(store):
+    shards = ShardScheduler(store, shards=4)
+    results = run_together(8, lambda i: shards.apply_move('R', increment)[1])
+    assert sorted(results) == list(range(1, 9))
+    assert store.get('R')['n'] == 8
+
+
+def test_moves_start_from_the_shard_copy(store):
+    shards = ShardScheduler(store, shards=2)
+    shards.apply_move('R', increment)
+    shards.apply_move('R', increment)
+    room_data, result = shards.apply_move('R', increment)
+    assert result == 3 and room_data['version'] == 4
+    assert store.gets == 1
+
+
+def test_stale_copy_is_reread_after_a_version_conflict(store):
+    shards = ShardScheduler(store, shards=2)
+    shards.apply_move('R', increment)
+    # Written outside the shard, e.g. by a join or another process
+    store.update('R', {'n': 10})
+
+    room_data, result = shards.apply_move('R', increment)
+    assert result == 11
+    assert store.conflicts == 1
+    assert store.gets == 2
+    assert store.get('R')['n'] == 11 and room_data['version'] == store.get('R')['version']
+
+
+def test_refusal_from_a_stale_copy_is_checked_against_the_store(store):
+    shards = ShardScheduler(store, shards=2)
+
+    def move(room_data):
+        if room_data['owner'] is None:
+            return None, 'closed'
+        return {'n': room_data['n'] + 1}, 'played'
+
+    assert shards.apply_move('R', move)[1] == 'closed'
+    store.update('R', {'owner': 1})
+    assert shards.apply_move('R', move)[1] == 'played'
+    assert store.get('R')['n'] == 1
+
+
+def test_missing_room(store):
+    shards = ShardScheduler(store, shards=2)
+    assert shards.apply_move('nope', increment) == (None, None)
+
+
+def test_move_errors_reach_the_caller(store):
+    shards = ShardScheduler(store, shards=2)
+
+    def broken(room_data):
+        raise ValueError('bad move')
+
+    with pytest.raises(ValueError):
+        shards.apply_move('R', broken)
+    # The shard keeps working
+    assert shards.apply_move('R', increment)[1] == 1
+
+
+def test_hash_ring_ownership_is_the_same_in_every_process():
+    ring = HashRing(NODES)
+    owners = {key: ring.node_for(key) for key in KEYS}
+
+    # Another interpreter with a different str hash seed must agree
+    script = ('import json, sys; from room_shards import HashRing; '
+              'ring = HashRing(json.loads(sys.argv[1])); '
+              'print(json.dumps({key: ring.node_for(key) for key in json.loads(sys.argv[2])}))')
+    env = dict(os.environ, PYTHONHASHSEED='12345')
+    output = subprocess.run(
+        [sys.executable, '-c', script, json.dumps(NODES), json.dumps(KEYS)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    assert json.loads(output) == owners
+
+    # Node order doesn't matter either
+    reordered = HashRing(list(reversed(NODES)))
+    assert all(reordered.node_for(key) == owner for key, owner in owners.items())
+
+
+def test_hash_ring_spreads_rooms_and_only_moves_them_to_a_new_node():
+    ring = HashRing(NODES)
+    owners = {key: ring.node_for(key) for key in KEYS}
+    for node in NODES:
+        assert 0.2 < list(owners.values()).count(node) / len(KEYS) < 0.5
+
+    grown = HashRing(NODES + ['http://game-4:5000'])
+    moved = [key for key in KEYS if grown.node_for(key) != owners[key]]
+    assert all(grown.node_for(key) == 'http://game-4:5000' for key in moved)
+    assert len(moved) / len(KEYS) < 0.4
+
+
+def test_scheduler_owner():
+    ring = HashRing(NODES)
+    shards = ShardScheduler(MemoryRoomStore(), shards=1, ring=ring, node=NODES[0])
+    for key in KEYS[:50]:
+        expected = ring.node_for(key)
+        assert shards.owner(key) == (None if expected == NODES[0] else expected)
+    with pytest.raises(ValueError):
+        ShardScheduler(MemoryRoomStore(), ring=ring, node='http://elsewhere:5000')
+
+
+def test_racing_player_actions_on_one_room():
+    import game
+
+    client = game.app.test_client()
+    created = client.get('/create_room').get_json()
+    room_key, token = created['room_key'], created['first_player_token']
+    client.get(f'/join_room/{room_key}')
+
+    def play(i):
+        response = game.app.test_client().get('/player_action', query_string={
+            'room_key': room_key, 'player_token': token, 'action': 'play', 'card_index': 0,
+        })
+        return response.status_code
+
+    statuses = run_together(10, play)
+    # The first play ends the turn; every other one finds it's not their turn
+    assert sorted(statuses) == [200] + [403] * 9
+    players = game.store.get(room_key)['players']
+    assert len(players[0]['field']) == 1
+
+
+def test_racing_joins_seat_and_deal_exactly_once():
+    import game
+
+    client = game.app.test_client()
+    for _ in range(10):
+        room_key = client.get('/create_room').get_json()['room_key']
+        responses = run_together(4, lambda i: game.app.test_client().get(f'/join_room/{room_key}'))
+
+        assert sorted(response.status_code for response in responses) == [200, 400, 400, 400]
+        token = next(r.get_json() for r in responses if r.status_code == 200)['second_player_token']
+        room_data = game.store.get(room_key)
+        assert room_data['players'][1]['token'] == token
+        assert [len(player['hand']) for player in room_data['players']] == [5, 5]
+
+
+def test_ring_without_shard_threads_applies_moves_inline(store):
+    shards = ShardScheduler(store, shards=0, ring=HashRing(NODES), node=NODES[0])
+    assert shards.apply_move('R', increment)[1] == 1
+    assert shards._shards is None
@@ -0,0 +1,143 @@
+"""Index of player tokens, for authenticating requests before loading a room.
+
+Every room this process reads or writes has its players' tokens recorded by
+their SHA-256 digest. Once both seats of a room have a token, the tokens
+never change, so a request for that room with any other token can be turned
+away without reading the room at all. Rooms not (fully) indexed yet, e.g.
+still waiting for a second player or created by another server process,
+are simply looked up in the store as before, which indexes them.
+
+Only digests are kept, so the index never holds a usable token, and lookups
+compare digests by dict key rather than comparing token strings. The index
+holds the max_rooms most recently used rooms; a room dropped from it is
+just read from the store again like one it never saw.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from storage import RoomStoreWrapper
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+# Rooms indexed at most, matching the room cache's default size
+DEFAULT_MAX_ROOMS = 10000
+
+
+class TokenIndex:
+    """Maps token digests to (room_key, player number) for recently used rooms."""
+
+    def __init__(self, max_rooms=DEFAULT_MAX_ROOMS):
+        self.max_rooms = max_rooms
+        self._players = {}                 # digest -> (room_key, player number)
+        self._room_tokens = OrderedDict()  # room_key -> digests, least recently used first
+        self._complete = set()             # Rooms whose seats all have tokens
+        self._lock = threading.Lock()
+
+    def add_room(self, room_key, room_data):
+        """Index the tokens in room_data's players."""
+        players = room_data.get('players', [])
+        digests = [
+            token_digest(player['token']) if isinstance(player.get('token'), str) else None
+            for player in players
+        ]
+        with self._lock:
+            for digest in self._room_tokens.pop(room_key, ()):
+                self._players.pop(digest, None)
+            self._complete.discard(room_key)
+            indexed = []
+            for number, digest in enumerate(digests, 1):
+                if digest is not None:
+                    self._players[digest] = (room_key, number)
+                    indexed.append(digest)
+            self._room_tokens[room_key] = indexed
+            if len(players) >= 2 and len(indexed) == len(players):
+                self._complete.add(room_key)
+            while len(self._room_tokens) > self.max_rooms:
+                oldest, digests = self._room_tokens.popitem(last=False)
+                for digest in digests:
+                    self._players.pop(digest, None)
+                self._complete.discard(oldest)
+
+    def is_complete(self, room_key):
+        """Return True if every seat of room_key is indexed."""
+        return room_key in self._complete
+
+    def player(self, room_key, token):
+        """Return the player number token belongs to in room_key, or None if not indexed."""
+        if not isinstance(token, str):
+            return None
+        entry = self._players.get(token_digest(token))
+        if entry is None or entry[0] != room_key:
+            return None
+        return entry[1]
+
+    def rejects(self, room_key, token):
+        """Return True if token is known not to belong to any player of room_key.
+
+        False means either that the token is valid or that the room isn't
+        fully indexed; the room has to be read to tell.
+        """
+        if not token or room_key not in self._complete:
+            return False
+        with self._lock:
+            # Checked again under the lock, as the room may have been evicted
+            if room_key not in self._complete:
+                return False
+            self._room_tokens.move_to_end(room_key)
+            return self.player(room_key, token) is None
+
+    def forget(self, room_key):
+        """Drop a room from the index, e.g. after it was deleted."""
+        with self._lock:
+            for digest in self._room_tokens.pop(room_key, ()):
+                self._players.pop(digest, None)
+            self._complete.discard(room_key)
+
+
+class TokenIndexingRoomStore(RoomStoreWrapper):
+    """RoomStore wrapper that keeps a TokenIndex up to date.
+
+    Rooms are indexed when created or overwritten, and when read while not
+    yet complete in the index. An update that touches players makes the next
+    read index the room again.
+    """
+
+    def __init__(self, backend, index):
+        super().__init__(backend)
+        self.index = index
+
+    def get(self, room_key, **kwargs):
+        return self._index(room_key, self.backend.get(room_key, **kwargs))
+
+    def snapshot(self, room_key):
+        return self._index(room_key, self.backend.snapshot(room_key))
+
+    def _index(self, room_key, room_data):
+        if room_data is None:
+            self.index.forget(room_key)
+        elif not self.index.is_complete(room_key):
+            self.index.add_room(room_key, room_data)
+        return room_data
+
+    def create(self, room_key, room_data):
+        self.backend.create(room_key, room_data)
+        self.index.add_room(room_key, room_data)
+
+    def set(self, room_key, room_data):
+        self.backend.set(room_key, room_data)
+        self.index.add_room(room_key, room_data)
+
+    def update(self, room_key, updates, expected_version=None):
+        self.backend.update(room_key, updates, expected_version=expected_version)
+        if any(_touches_players(path) for path in updates):
+            # Tokens of complete rooms never change; others get re-read
+            if not self.index.is_complete(room_key):
+                self.index.forget(room_key)
+
+
+def _touches_players(path):
+    return (path[0] if isinstance(path, tuple) else path.split('.', 1)[0]) == 'players'
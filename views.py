@@ -0,0 +1,168 @@
+"""Player-visible projections of a room.
+
+Rooms hold everything, including the deck order and both hands. The
+functions here build what one player is allowed to see directly from the
+room data, without copying the room first, and PlayerViewBuilder reuses the
+parts of a view that didn't change since the room's previous version.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from cards import card_info, expand_cards
+
+# Room fields no player may see
+HIDDEN_FIELDS = ('deck',)
+
+
+def filter_game_data_for_player(game_data, player_number):
+    """
+    Filter game data to only show information visible to the requesting player.
+
+    The result shares unchanged values with game_data instead of copying
+    them, so treat it as read-only.
+
+    Args:
+        game_data (dict): The complete game data from the room store
+        player_number (int): The player number (1 or 2) making the request
+
+    Returns:
+        dict: Filtered game data with hidden information removed
+    """
+    if not game_data:
+        return {}
+
+    # Copy only the top level, leaving out what nobody may see
+    filtered_data = {key: value for key, value in game_data.items() if key not in HIDDEN_FIELDS}
+    if 'deck' in game_data:
+        filtered_data['deck_count'] = len(game_data['deck'])
+
+    # Determine opponent number
+    opponent_index = (2 if player_number == 1 else 1) - 1
+
+    # Hide opponent's hand (but keep the image field) and token
+    if 'players' in game_data:
+        players = list(game_data['players'])
+        if len(players) > opponent_index:
+            opponent = {key: value for key, value in players[opponent_index].items() if key != 'token'}
+            if 'hand' in opponent:
+                opponent['hand'] = [
+                    {'face_down': True, 'image': card_info(card).get('image', '')}
+                    for card in opponent['hand']
+                ]
+            players[opponent_index] = opponent
+        filtered_data['players'] = players
+
+    # Mark the opponent's face-down play area cards and ensure image fields exist
+    if 'play_area' in game_data:
+        play_area = []
+        for card in game_data['play_area']:
+            if card.get('owner') == opponent_index + 1 and card.get('face_down', False):
+                card = dict(card, hidden=True)
+            if 'image' not in card:
+                card = dict(card, image='')
+            play_area.append(card)
+        filtered_data['play_area'] = play_area
+
+    return filtered_data
+
+
+def build_player_view(room_data, player_idx, previous=None):
+    """Build the render_info view of a room for one player.
+
+    Args:
+        room_data: The room data dictionary
+        player_idx: Index of the player in room_data['players'] (0 or 1)
+        previous: Optional (view, sources) pair from an earlier version of
+            the same room and player. Card lists that are unchanged since
+            then are reused instead of being expanded again.
+
+    Returns:
+        tuple: (view, sources), where sources records the card ids each card
+               list was built from, for passing back in as previous
+    """
+    players = room_data.get('players', [])
+    opponent_idx = 1 if player_idx == 0 else 0
+    player_data = players[player_idx] if player_idx < len(players) else {}
+    opponent_data = players[opponent_idx] if opponent_idx < len(players) else {}
+
+    sources = {
+        'player_field': tuple(player_data.get('field', [])),
+        'opponent_field': tuple(opponent_data.get('field', [])),
+        'player_hand': tuple(player_data.get('hand', [])),
+    }
+    card_lists = {}
+    for name, cards in sources.items():
+        if previous is not None and previous[1][name] == cards:
+            card_lists[name] = previous[0][name]
+        else:
+            card_lists[name] = expand_cards(cards)
+
+    view = {
+        'player_field': card_lists['player_field'],
+        'opponent_field': card_lists['opponent_field'],
+        'player_hand': card_lists['player_hand'],
+        'opponent_hand_count': len(opponent_data.get('hand', [])),
+        'player_score': player_data.get('score', 0),
+        'opponent_score': opponent_data.get('score', 0),
+        'current_turn': room_data.get('current_turn'),
+        'game_state': room_data.get('game_state', 'unknown'),
+        'your_turn': room_data.get('current_turn') == player_idx + 1,
+        'version': room_data.get('version', 0)
+    }
+    return view, sources
+
+
+class _CachedView:
+    __slots__ = ('view', 'sources', 'body')
+
+    def __init__(self, view, sources):
+        self.view = view
+        self.sources = sources
+        self.body = None
+
+
+class PlayerViewBuilder:
+    """Caches the latest view of each room for each player.
+
+    Polls of an unchanged room version get the same view object (and the
+    same serialized body) back, and a new version only rebuilds the parts
+    that changed. Views are shared between requests and must not be modified.
+    """
+
+    def __init__(self, serialize=json.dumps, max_views=20000):
+        self.serialize = serialize
+        self.max_views = max_views
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def view(self, room_key, room_data, player_idx):
+        """Return the render_info view of room_data for one player."""
+        return self._entry(room_key, room_data, player_idx).view
+
+    def body(self, room_key, room_data, player_idx):
+        """Return the serialized render_info view, serializing once per version."""
+        entry = self._entry(room_key, room_data, player_idx)
+        if entry.body is None:
+            # Two requests may race to fill this in; both produce the same text
+            entry.body = self.serialize(entry.view)
+        return entry.body
+
+    def _entry(self, room_key, room_data, player_idx):
+        cache_key = (room_key, player_idx)
+        version = room_data.get('version', 0)
+        with self._lock:
+            previous = self._views.get(cache_key)
+        if previous is not None and previous.view['version'] == version:
+            return previous
+
+        entry = _CachedView(*build_player_view(
+            room_data, player_idx,
+            (previous.view, previous.sources) if previous is not None else None
+        ))
+        with self._lock:
+            self._views[cache_key] = entry
+            self._views.move_to_end(cache_key)
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+        return entry